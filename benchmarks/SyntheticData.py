@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+
+class SyntheticData:
+    @staticmethod
+    def funda(n_firms, n_years, start_year=1995, seed=0):
+        """Deterministic comp.funda shaped panel with one fiscal-year row per firm, ordered by datadate."""
+        rng = np.random.default_rng(seed)
+        firm = np.repeat(np.arange(n_firms), n_years)
+        year = np.tile(np.arange(n_years), n_firms)
+        n_rows = len(firm)
+
+        # Each firm keeps its fiscal year end month and grows its balance sheet along a random walk
+        fiscal_month = rng.integers(1, 13, n_firms)[firm]
+        datadate = (pd.to_datetime(pd.DataFrame({'year': start_year + year, 'month': fiscal_month, 'day': 1}))
+                    + pd.offsets.MonthEnd(0))
+        log_growth = rng.normal(0.05, 0.2, n_rows).reshape(n_firms, n_years).cumsum(axis=1).ravel()
+        at = np.exp(rng.normal(6, 1.5, n_firms)[firm] + log_growth)
+        sale = at * rng.uniform(0.3, 1.5, n_rows)
+
+        funda = pd.DataFrame({
+            'gvkey': np.char.zfill((100000 + firm).astype(str), 6),
+            'datadate': datadate,
+            'fyear': start_year + year,
+            'fic': 'USA',
+            'tic': np.char.add('T', firm.astype(str)),
+            'at': at,
+            'lt': at * rng.uniform(0.2, 0.9, n_rows),
+            'aco': at * rng.uniform(0.05, 0.4, n_rows),
+            'lco': at * rng.uniform(0.05, 0.3, n_rows),
+            'csho': np.round(at / 10 * rng.uniform(0.9, 1.1, n_rows), 3),
+            'ni': at * rng.normal(0.03, 0.08, n_rows),
+            'oancf': at * rng.normal(0.06, 0.08, n_rows),
+            'dltt': at * rng.uniform(0, 0.5, n_rows),
+            'mkvalt': at * rng.uniform(0.5, 3, n_rows),
+            'ebit': at * rng.normal(0.08, 0.06, n_rows),
+            'dlc': at * rng.uniform(0, 0.1, n_rows),
+            'che': at * rng.uniform(0.01, 0.2, n_rows),
+            're': at * rng.normal(0.2, 0.3, n_rows),
+            'sale': sale,
+            'cogs': sale * rng.uniform(0.4, 0.95, n_rows),
+            'xsga': sale * rng.uniform(0.05, 0.3, n_rows),
+            'xrd': sale * rng.uniform(0, 0.1, n_rows),
+            'dp': at * rng.uniform(0.01, 0.05, n_rows),
+            'cusip': SyntheticData.cusips(n_firms)[firm],
+        })
+
+        # Compustat has gaps: blank out a few inputs so the missing-value filters have work to do
+        for column in ['aco', 'lco', 'oancf', 'dltt']:
+            funda.loc[rng.random(n_rows) < 0.02, column] = np.nan
+        return funda.sort_values('datadate', kind='mergesort').reset_index(drop=True)
+
+    @staticmethod
+    def crsp(funda, seed=0):
+        """Deterministic crsp.dsf shaped panel for the firms in funda, one row per firm and business day over
+        funda's calendar years, ordered by date. Prices start at each firm's first mkvalt / csho and follow its
+        daily returns, so market caps are in line with funda. Numeric columns are float32 and cusip is the 8
+        character categorical DataStore.read returns, which keeps the largest sizes within memory."""
+        rng = np.random.default_rng(seed)
+        firms = funda.sort_values('datadate', kind='mergesort').drop_duplicates('cusip')
+        dates = pd.bdate_range(f"{funda['datadate'].min().year}-01-01", f"{funda['datadate'].max().year}-12-31")
+        n_days, n_firms = len(dates), len(firms)
+
+        ret = rng.standard_normal((n_days, n_firms), dtype=np.float32)
+        ret *= np.float32(0.02)
+        ret += np.float32(0.0003)
+        prc = np.cumprod(1 + ret, axis=0, dtype=np.float32)
+        prc *= (firms['mkvalt'] / firms['csho']).to_numpy(dtype=np.float32)
+        shrout = (firms['csho'] * 1000).to_numpy(dtype=np.float32)  # Thousands of shares, csho is in millions
+        ret[rng.random((n_days, n_firms), dtype=np.float32) < 0.01] = np.nan
+
+        # A few firms stop trading for a couple of months, so as-of lookups and inactivity removal have work to do
+        traded = np.ones((n_days, n_firms), dtype=bool)
+        for firm in np.flatnonzero(rng.random(n_firms) < 0.05):
+            halt_start = rng.integers(0, n_days)
+            traded[halt_start:halt_start + rng.integers(20, 90), firm] = False
+        traded = traded.ravel()
+
+        firm = np.broadcast_to(np.arange(n_firms, dtype=np.int32), (n_days, n_firms)).ravel()[traded]
+        return pd.DataFrame({
+            'permno': 10000 + firm,
+            'date': np.repeat(dates.to_numpy(), n_firms)[traded],
+            'ret': ret.ravel()[traded],
+            'prc': prc.ravel()[traded],
+            'shrout': shrout[firm],
+            'cusip': pd.Categorical.from_codes(firm, categories=firms['cusip'].str[:8].to_numpy()),
+        })
+
+    @staticmethod
+    def cusips(n_firms):
+        """Unique 9 character CUSIPs, 8 character issuer/issue code plus a check digit."""
+        return np.char.add(np.char.zfill(np.arange(n_firms).astype(str), 8), '1').astype(object)
@@ -0,0 +1,221 @@
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.SyntheticData import SyntheticData
+from src.DataHandler import DataHandler, FUNDA_COLUMNS, CRSP_COLUMNS, CRSP_DTYPES
+from src.FactorEngine import FactorEngine
+from src.Instrumentation import Instrumentation
+from src.SecurityMaster import SecurityMaster
+from src.StrategyRunner import StrategyRunner
+
+# Panel sizes as (firms, years), from a quick check up to roughly the full Compustat / CRSP universe
+SIZES = {
+    'small': (500, 5),
+    'medium': (2000, 10),
+    'large': (5000, 20),
+    'xlarge': (20000, 30),  # About 150M crsp rows, needs tens of GB of memory
+}
+BENCHMARKS = ['add_piotroski_column_to_funda', 'clean_funda', 'clean_crsp', 'merge_funda_with_crsp', 'run_strategy',
+              'process_returns']
+START_YEAR = 1995
+# Strategy parameters, as in piotroski.py
+LONG_PORTFOLIO_SIZE = 20
+SHORT_PORTFOLIO_SIZE = 10
+INACTIVITY_THRESHOLD = 30
+MARKET_CAP_THRESHOLD = 2_000_000_000
+PORTFOLIO_UPDATE_DELAY = 60
+
+
+def load_synthetic_data(firms, years, seed):
+    """Raw synthetic funda, plus funda and crsp as DataHandler.read_data returns them from the store."""
+    raw_funda = SyntheticData.funda(firms, years, start_year=START_YEAR, seed=seed)
+    funda = DataHandler.add_piotroski_column_to_funda(raw_funda.copy())[FUNDA_COLUMNS + FactorEngine.columns()]
+    funda = funda.astype({'cusip': 'category'})
+    crsp = SyntheticData.crsp(raw_funda, seed=seed)[CRSP_COLUMNS]
+    security_master = SecurityMaster.from_columns(funda['cusip'], crsp['cusip'])
+    funda = security_master.encode(funda)
+    crsp = security_master.encode(crsp).astype(CRSP_DTYPES, copy=False)
+    return raw_funda, funda, crsp
+
+
+def measure(setup, func, repeat, measure_memory):
+    """Time func(*setup()) repeat times, setup excluded. With measure_memory, one more call runs under tracemalloc
+    to get the peak memory func allocates on top of its inputs. Returns the result of the last timed call."""
+    seconds = []
+    peak_memory_mb = None
+    # Keep the stages' progress messages out of the benchmark output
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            args = setup()
+            gc.collect()
+            start = time.perf_counter()
+            result = func(*args)
+            seconds.append(time.perf_counter() - start)
+            del args
+
+        if measure_memory:
+            args = setup()
+            gc.collect()
+            tracemalloc.start()
+            func(*args)
+            peak_memory_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+            del args
+    return result, {'seconds': min(seconds), 'seconds_all': seconds, 'peak_memory_mb': peak_memory_mb}
+
+
+def run_strategy(strategy_runner):
+    strategy_runner.run_strategy(show_progress=False)
+    return strategy_runner
+
+
+def copy_strategy_runner(strategy_runner):
+    """Copy of a strategy runner that process_returns can run on without changing the original."""
+    strategy_runner = copy.copy(strategy_runner)
+    strategy_runner.daily_strategy_returns = strategy_runner.daily_strategy_returns.copy()
+    strategy_runner.cumulative_strategy_returns = strategy_runner.cumulative_strategy_returns.copy()
+    return strategy_runner
+
+
+def benchmark_size(size, firms, years, benchmarks, repeat, measure_memory, seed):
+    """Benchmark the pipeline stages on one synthetic panel, feeding each stage the previous stage's output."""
+    start_date, end_date = f'{START_YEAR + 1}-01-01', f'{START_YEAR + years - 1}-12-31'
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        raw_funda, funda, crsp = load_synthetic_data(firms, years, seed)
+        # The store only returns crsp partitions inside the date window
+        crsp = crsp[(crsp['date'] >= start_date) & (crsp['date'] <= end_date)].copy()
+        clean_funda = DataHandler.clean_funda(funda.copy(), start_date, end_date, MARKET_CAP_THRESHOLD, crsp.copy())
+        prepared_funda = DataHandler.prepare_funda(funda.copy(), start_date, end_date)
+        crsp_with_market_cap = DataHandler.calculate_market_cap(crsp.copy())
+        clean_crsp = DataHandler.clean_crsp(crsp.copy())
+    print(f"{size}: {firms:,} firms x {years} years, {len(raw_funda):,} funda rows, {len(crsp):,} crsp rows")
+    strategy_runner = None
+
+    cases = {
+        'add_piotroski_column_to_funda': (lambda: (raw_funda.copy(),), DataHandler.add_piotroski_column_to_funda,
+                                          len(raw_funda)),
+        'clean_funda': (lambda: (funda.copy(), start_date, end_date, MARKET_CAP_THRESHOLD, crsp.copy()),
+                        DataHandler.clean_funda, len(funda)),
+        'clean_crsp': (lambda: (crsp.copy(),), DataHandler.clean_crsp, len(crsp)),
+        'merge_funda_with_crsp': (lambda: (prepared_funda.copy(), crsp_with_market_cap.copy()),
+                                  DataHandler.merge_funda_with_crsp, len(prepared_funda)),
+        'run_strategy': (lambda: (StrategyRunner(clean_funda, clean_crsp, INACTIVITY_THRESHOLD, LONG_PORTFOLIO_SIZE,
+                                                 SHORT_PORTFOLIO_SIZE, start_date, end_date,
+                                                 PORTFOLIO_UPDATE_DELAY),),
+                         run_strategy, len(clean_crsp)),
+        'process_returns': (lambda: (copy_strategy_runner(strategy_runner),), StrategyRunner.process_returns, None),
+    }
+
+    results = []
+    for name in [name for name in BENCHMARKS if name in benchmarks]:
+        if name == 'process_returns' and strategy_runner is None:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                strategy_runner = run_strategy(cases['run_strategy'][0]()[0])
+        setup, func, rows_in = cases[name]
+        result, timings = measure(setup, func, repeat, measure_memory)
+        if name == 'run_strategy':
+            strategy_runner = result
+        elif name == 'process_returns':
+            rows_in = len(strategy_runner.daily_strategy_returns)
+        results.append({'size': size, 'firms': firms, 'years': years, 'benchmark': name, 'rows_in': rows_in,
+                        **timings})
+        print(f"  {name:<32}{timings['seconds']:10.3f}s" + (f"{timings['peak_memory_mb']:10.1f} MB"
+                                                             if measure_memory else ''))
+    return results, Instrumentation.peak_rss_mb()
+
+
+def git_revision():
+    """Current commit and whether the working tree has uncommitted changes, or (None, None) outside git."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                    text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def save_results(results, directory):
+    """Save a run to <directory>/<timestamp>_<commit>.json and return its path."""
+    commit, dirty = git_revision()
+    created = pd.Timestamp.now()
+    run = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': created.isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': f"{platform.system()} {platform.machine()}, {os.cpu_count()} cores",
+        'results': results,
+    }
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{created:%Y%m%d_%H%M%S}_{commit or 'nogit'}.json")
+    with open(path, 'w') as results_file:
+        json.dump(run, results_file, indent=2)
+    return path
+
+
+def compare(baseline_path, results, tolerance, min_seconds):
+    """Compare results against a saved run. A stage regresses when it is more than tolerance slower and the
+    difference is above min_seconds, which keeps timer noise on very short stages out. Returns the comparison."""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    keys = ['size', 'benchmark']
+    comparison = pd.DataFrame(results)[keys + ['seconds', 'peak_memory_mb']].merge(
+        pd.DataFrame(baseline['results'])[keys + ['seconds', 'peak_memory_mb']], on=keys,
+        suffixes=('', '_baseline'))
+    comparison['ratio'] = comparison['seconds'] / comparison['seconds_baseline']
+    comparison['regression'] = ((comparison['ratio'] > 1 + tolerance)
+                                & (comparison['seconds'] - comparison['seconds_baseline'] > min_seconds))
+    print(f"Compared with {baseline['commit']} ({baseline['created']})")
+    print(comparison.to_string(index=False, float_format=lambda value: f'{value:.3f}'))
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the screening and backtest pipeline on synthetic data.")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    parser.add_argument('--firms', type=int, help="Benchmark a custom size instead, together with --years")
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage, the fastest is reported")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc run of each stage")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-directory', default=os.path.join(os.path.dirname(__file__), 'results'))
+    parser.add_argument('--compare', metavar='RESULTS_FILE', help="Saved run to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown before a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.05, help="Ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    sizes = {'custom': (args.firms, args.years)} if args.firms else {size: SIZES[size] for size in args.sizes}
+    results = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        warnings.simplefilter('ignore', FutureWarning)
+        for size, (firms, years) in sizes.items():
+            size_results, peak_rss_mb = benchmark_size(size, firms, years, args.benchmarks, args.repeat,
+                                                       not args.no_memory, args.seed)
+            for result in size_results:
+                result['process_peak_rss_mb'] = peak_rss_mb
+            results += size_results
+    print(f"Results saved to {save_results(results, args.output_directory)}")
+
+    if args.compare:
+        comparison = compare(args.compare, results, args.tolerance, args.min_seconds)
+        if comparison['regression'].any():
+            sys.exit(f"{comparison['regression'].sum()} stage(s) slower than the baseline")
@@ -0,0 +1,104 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks.SyntheticData import SyntheticData
+from src.DataHandler import DataHandler
+from src.DataStore import DataStore
+from src.FactorEngine import FactorEngine
+from src.wrds_api.LocalSQLConnection import LocalSQLConnection
+from src.wrds_api.WRDSConnection import WRDSConnection
+
+# comp.funda columns the download queries select that SyntheticData doesn't generate
+MISSING_FUNDA_COLUMNS = ['pstkl', 'txditc', 'pstkrv', 'txdb', 'pstk', 'ivst', 'xint']
+# The WRDS filters every funda query applies
+FUNDA_FILTERS = {'indfmt': 'INDL', 'datafmt': 'STD', 'popsrc': 'D', 'consol': 'C'}
+PATHS = ['full', 'concurrent', 'incremental']
+
+
+def build_databases(directory, firms, years, start_year, seed):
+    """Write SyntheticData panels as comp.funda and crsp.dsf SQLite databases, returning their paths by library."""
+    funda = SyntheticData.funda(firms, years, start_year=start_year, seed=seed)
+    crsp = SyntheticData.crsp(funda, seed=seed)
+    funda = funda.assign(datadate=funda['datadate'].dt.strftime('%Y-%m-%d'), **FUNDA_FILTERS,
+                         **{column: 0.0 for column in MISSING_FUNDA_COLUMNS})
+    crsp = crsp.assign(date=crsp['date'].dt.strftime('%Y-%m-%d'), cusip=crsp['cusip'].astype(str))
+
+    libraries = {'comp': os.path.join(directory, 'comp.db'), 'crsp': os.path.join(directory, 'crsp.db')}
+    for library, table_name, table in [('comp', 'funda', funda), ('crsp', 'dsf', crsp)]:
+        with sqlite3.connect(libraries[library]) as connection:
+            table.to_sql(table_name, connection, index=False, if_exists='replace')
+    # The market cap lookup of factor_inputs_query needs crsp.dsf indexed like on WRDS
+    with sqlite3.connect(libraries['crsp']) as connection:
+        connection.execute("CREATE INDEX dsf_cusip_date ON dsf (cusip, date)")
+    return libraries
+
+
+def download(store, libraries, path, start_date, end_date, sql_features, connections):
+    """Fill the store through one of the download paths, incremental downloading half the window first."""
+    def connect():
+        return WRDSConnection(None, None, db=LocalSQLConnection.sqlite(libraries))
+
+    if path == 'full':
+        DataHandler.download_data(store, start_date, end_date, connect(), sql_features=sql_features)
+    elif path == 'concurrent':
+        DataHandler.download_data_concurrently(store, start_date, end_date, connections, connect,
+                                               sql_features=sql_features)
+    else:
+        middle_date = pd.Timestamp(start_date) + (pd.Timestamp(end_date) - pd.Timestamp(start_date)) / 2
+        DataHandler.download_data(store, start_date, f'{middle_date:%Y-%m-%d}', connect(), sql_features=sql_features)
+        DataHandler.update_data(store, end_date, connect(), sql_features=sql_features)
+
+
+def cleaned_funda(store, start_date, end_date, market_cap_threshold):
+    """clean_funda's output with CUSIPs in place of security ids, which depend on what each store holds."""
+    funda, crsp, security_master = DataHandler.read_data(store, start_date, end_date)
+    funda = DataHandler.clean_funda(funda, start_date, end_date, market_cap_threshold, crsp)
+    funda['cusip'] = security_master.decode(funda['security_id'])
+    columns = ['cusip', 'tic', 'datadate', 'market_cap'] + FactorEngine.columns()
+    return funda[columns].sort_values(['cusip', 'datadate'], kind='mergesort').reset_index(drop=True)
+
+
+def check_parity(reference, cleaned):
+    """Raise if a download path's cleaned funda disagrees with the reference. The database computes market caps
+    in float64 from float32 prices, hence the tolerance."""
+    pd.testing.assert_frame_equal(reference, cleaned, check_dtype=False, rtol=1e-6)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the cleaned funda of the pandas and SQL feature download "
+                                                 "paths on a local SQLite copy of synthetic WRDS tables.")
+    parser.add_argument('--firms', type=int, default=300)
+    parser.add_argument('--years', type=int, default=8)
+    parser.add_argument('--start-year', type=int, default=2013)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--connections', type=int, default=4, help="Connections of the concurrent path")
+    parser.add_argument('--market-cap-threshold', type=float, default=2_000_000_000)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore', FutureWarning)
+
+    # The first year only supplies lags
+    start_date, end_date = f'{args.start_year + 1}-01-01', f'{args.start_year + args.years - 1}-12-31'
+    with tempfile.TemporaryDirectory() as directory:
+        libraries = build_databases(directory, args.firms, args.years, args.start_year, args.seed)
+        print(f"Synthetic WRDS tables: {args.firms:,} firms x {args.years} years, window {start_date} to {end_date}")
+
+        reference = None
+        for sql_features in [False, True]:
+            for path in PATHS:
+                store = DataStore(os.path.join(directory, f'store_{path}_{sql_features}'))
+                start = time.perf_counter()
+                download(store, libraries, path, start_date, end_date, sql_features, args.connections)
+                seconds = time.perf_counter() - start
+                cleaned = cleaned_funda(store, start_date, end_date, args.market_cap_threshold)
+                if reference is None:
+                    reference = cleaned
+                else:
+                    check_parity(reference, cleaned)
+                print(f"{'SQL' if sql_features else 'pandas':<6} {path:<12} {seconds:8.3f}s  {len(cleaned):,} rows")
+    print("Cleaned funda identical on every path")
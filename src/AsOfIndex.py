@@ -0,0 +1,53 @@
+import numpy as np
+
+from src.Instrumentation import Instrumentation
+from src.MappedArrays import MappedArrays
+
+
+class AsOfIndex(MappedArrays):
+    """A daily value per security, e.g. crsp market cap, sorted once by (security id, date) and kept as flat
+    arrays, answering "latest value on or before date d" for batches of (security id, date) queries.
+
+    Each row's key is security_id * day_span + its day number, so one sorted key array holds every security's
+    history back to back and a whole batch of queries is a single np.searchsorted, with no grouping or
+    re-sorting. Saved and loaded through MappedArrays."""
+
+    ARRAYS = ['keys', 'values', 'days']
+
+    def __init__(self, keys, values, days):
+        self.keys = keys
+        self.values = values
+        self.days = days  # [first day number, day_span]
+        self.first_day, self.day_span = int(days[0]), int(days[1])
+
+    @classmethod
+    @Instrumentation.stage()
+    def from_columns(cls, security_ids, dates, values):
+        """Index values by security id and date. Rows with an unknown security or date are left out, and of
+        several rows on the same security and date the last one wins."""
+        security_ids = np.asarray(security_ids, dtype='int64')
+        days = np.asarray(dates, dtype='datetime64[D]')
+        known = (security_ids >= 0) & ~np.isnat(days)
+        security_ids, days, values = security_ids[known], days[known].astype('int64'), np.asarray(values)[known]
+
+        first_day = int(days.min()) if len(days) else 0
+        # One spare day below every security's history, for queries dated before its first row
+        day_span = (int(days.max()) - first_day + 2) if len(days) else 1
+        keys = security_ids * day_span + (days - first_day)
+        order = np.argsort(keys, kind='stable')
+        return cls(keys[order], values[order], np.array([first_day, day_span], dtype='int64'))
+
+    def as_of(self, security_ids, dates):
+        """Value of each security on the latest date on or before the matching date, NaN where there is none.
+        dates may be a single date shared by every query."""
+        security_ids = np.asarray(security_ids, dtype='int64')
+        days = np.broadcast_to(np.asarray(dates, dtype='datetime64[D]').astype('int64'), security_ids.shape)
+        day_offsets = np.clip(days - self.first_day, -1, self.day_span - 2)
+        positions = np.searchsorted(self.keys, security_ids * self.day_span + day_offsets, side='right') - 1
+
+        # A match below the security's own block belongs to the previous security, so there's no value yet
+        found = (security_ids >= 0) & (positions >= 0)
+        found[found] &= self.keys[positions[found]] >= security_ids[found] * self.day_span
+        as_of_values = np.full(security_ids.shape, np.nan, dtype=np.result_type(self.values.dtype, np.float32))
+        as_of_values[found] = self.values[positions[found]]
+        return as_of_values
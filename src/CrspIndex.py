@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from src.Instrumentation import Instrumentation
+from src.MappedArrays import MappedArrays
+
+
+class CrspIndex(MappedArrays):
+    """crsp sorted by date once and kept as flat arrays: each row's security id and return, plus where every
+    date's rows start and end. Rows keep their original order within a date so averages sum in the same order.
+    Saved and loaded through MappedArrays."""
+
+    ARRAYS = ['dates', 'day_starts', 'day_ends', 'security_ids', 'returns']
+
+    def __init__(self, dates, day_starts, day_ends, security_ids, returns):
+        self.dates = dates
+        self.day_starts = day_starts
+        self.day_ends = day_ends
+        self.security_ids = security_ids
+        self.returns = returns
+        self.day_positions = {pd.Timestamp(date): position for position, date in enumerate(dates)}
+
+    @classmethod
+    @Instrumentation.stage()
+    def from_crsp(cls, crsp):
+        crsp = crsp[crsp['date'].notna()].sort_values('date', kind='mergesort')
+        row_dates = crsp['date'].to_numpy(dtype='datetime64[ns]')
+        day_starts = np.flatnonzero(np.r_[True, row_dates[1:] != row_dates[:-1]][:len(row_dates)])
+        day_ends = np.r_[day_starts[1:], len(row_dates)][:len(day_starts)]
+        return cls(row_dates[day_starts], day_starts, day_ends, crsp['security_id'].to_numpy(dtype='int32'),
+                   crsp['ret'].to_numpy(dtype='float32'))
+
+    def __contains__(self, date):
+        return date in self.day_positions
+
+    def day(self, date):
+        """Security ids and returns of the rows dated date."""
+        position = self.day_positions[date]
+        start, end = self.day_starts[position], self.day_ends[position]
+        return self.security_ids[start:end], self.returns[start:end]
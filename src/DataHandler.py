@@ -1,46 +1,167 @@
-import os
-
+import numpy as np
 import pandas as pd
 
+from src.AsOfIndex import AsOfIndex
+from src.DataStore import DataStore
+from src.Instrumentation import Instrumentation
+from src.FactorEngine import FactorEngine
+from src.QueryPlan import QueryPlan
+from src.SecurityMaster import SecurityMaster
 from src.wrds_api.WRDSCredentialsLoader import EnvironmentLoader
 from src.wrds_api.WRDSConnection import WRDSConnection
+from src.wrds_api.WRDSConnectionPool import WRDSConnectionPool
+
+# Columns the screening and backtest pipeline reads back from the store, besides the factor columns
+FUNDA_COLUMNS = ['cusip', 'tic', 'datadate', 'roa', 'cfo', 'delta_leverage', 'delta_margin', 'delta_turn']
+CRSP_COLUMNS = ['cusip', 'date', 'ret', 'prc', 'shrout']
+# Columns the Piotroski score is calculated from, a filing missing any of them is dropped
+SCORE_INPUT_COLUMNS = ['roa', 'cfo', 'delta_leverage', 'delta_margin', 'delta_turn']
+# Compact in-memory types for crsp, which is what bounds how much history fits in memory
+CRSP_DTYPES = {'ret': 'float32', 'prc': 'float32', 'shrout': 'float32'}
+# How far before the latest stored datadate an incremental refresh looks for late filings
+FUNDA_REVISION_WINDOW_DAYS = 365
 
 
 class DataHandler:
     @staticmethod
-    def fetch_or_read_data(get_new_data, start_date, end_date):
+    @Instrumentation.stage()
+    def fetch_or_read_data(get_new_data, start_date, end_date, store_directory="../input_data", incremental=False,
+                           sql_features=False, download_connections=1):
+        """sql_features downloads funda with the factor lags and market caps already computed by the database,
+        see WRDSConnection.download_factor_inputs. With more than one download connection, a full download
+        runs its queries in parallel."""
+        store = DataStore(store_directory)
         if get_new_data:
-            funda, crsp = DataHandler.download_data(start_date, end_date)
-            funda = DataHandler.add_piotroski_column_to_funda(funda)
-            DataHandler.save_file_to_directory(funda, "../input_data", "funda.csv")
-            DataHandler.save_file_to_directory(crsp, "../input_data", "crsp.csv")
-            return funda, crsp
+            if incremental and store.exists('funda') and store.exists('crsp'):
+                DataHandler.update_data(store, end_date, sql_features=sql_features)
+            elif download_connections > 1:
+                DataHandler.download_data_concurrently(store, start_date, end_date, download_connections,
+                                                       sql_features=sql_features)
+            else:
+                DataHandler.download_data(store, start_date, end_date, sql_features=sql_features)
+        return DataHandler.read_data(store, start_date, end_date)
+
+    @staticmethod
+    def connect_to_wrds():
+        wrds_credentials = EnvironmentLoader.load_wrds_credentials()
+        return WRDSConnection(wrds_credentials['wrds_username'], wrds_credentials['wrds_password'])
+
+    @staticmethod
+    @Instrumentation.stage()
+    def download_data(store, start_date, end_date, wrds_connection=None, sql_features=False):
+        """Download funda and CRSP into the store. CRSP is streamed month by month and resumes if interrupted."""
+        print("Downloading Data")
+        wrds_connection = wrds_connection or DataHandler.connect_to_wrds()
+        if sql_features:
+            funda = wrds_connection.download_factor_inputs(start_date, end_date, lag_start_date=start_date)
+            funda = DataHandler.add_piotroski_column_to_lagged_funda(funda)
         else:
-            return DataHandler.read_data('../input_data/funda.csv', '../input_data/crsp.csv')
+            funda = wrds_connection.download_fundamental_data(start_date, end_date)
+            funda = DataHandler.add_piotroski_column_to_funda(funda)
+        store.write('funda', funda)
+        del funda
+        wrds_connection.stream_crsp_data(store, start_date, end_date)
+        wrds_connection.close()
 
     @staticmethod
-    def download_data(start_date, end_date):
+    @Instrumentation.stage()
+    def download_data_concurrently(store, start_date, end_date, connections=4, connect=None, sql_features=False):
+        """download_data with the funda query and the monthly CRSP queries running in parallel over a pool of
+        connections, each query retried if it fails. Results are written to the store as they arrive, and CRSP
+        months saved by an interrupted download are not fetched again."""
         print("Downloading Data")
-        wrds_credentials = EnvironmentLoader.load_wrds_credentials()
-        wrds_connection = WRDSConnection(wrds_credentials['wrds_username'], wrds_credentials['wrds_password'])
-        funda = wrds_connection.download_fundamental_data(start_date, end_date)
-        crsp = wrds_connection.download_crsp_data(start_date, end_date)
+        if sql_features:
+            funda_query = WRDSConnection.factor_inputs_query(start_date, end_date, lag_start_date=start_date)
+        else:
+            funda_query = WRDSConnection.funda_query(start_date, end_date)
+        crsp_queries = WRDSConnection.crsp_chunk_queries(start_date, end_date)
+        remaining_keys = store.begin_chunked_write('crsp', list(crsp_queries))
+        queries = {('funda', None): funda_query}
+        queries.update({('crsp', chunk_key): crsp_queries[chunk_key] for chunk_key in remaining_keys})
+
+        connection_pool = WRDSConnectionPool(connect or DataHandler.connect_to_wrds, connections)
+        try:
+            for (table_name, chunk_key), result in connection_pool.run_queries(queries):
+                if table_name == 'crsp':
+                    store.write_chunk('crsp', chunk_key, result)
+                elif sql_features:
+                    store.write('funda', DataHandler.add_piotroski_column_to_lagged_funda(result))
+                else:
+                    store.write('funda', DataHandler.add_piotroski_column_to_funda(result))
+        finally:
+            connection_pool.close()
+        store.finish_chunked_write('crsp')
+
+    @staticmethod
+    @Instrumentation.stage()
+    def update_data(store, end_date, wrds_connection=None, sql_features=False):
+        """Fetch only filings and trading days newer than what the store already holds, and append them."""
+        if sql_features != ('market_cap' in store.stored_schema('funda').names):
+            raise ValueError(f"The stored funda was {'not ' if sql_features else ''}downloaded with sql_features, "
+                             f"download it again instead of updating it")
+        print("Updating Data")
+        wrds_connection = wrds_connection or DataHandler.connect_to_wrds()
+        DataHandler.update_funda(store, wrds_connection, end_date, sql_features)
+        DataHandler.update_crsp(store, wrds_connection, end_date)
         wrds_connection.close()
-        return funda, crsp
 
     @staticmethod
-    def save_file_to_directory(funda, directory, file_name):
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        print("Saving data")
-        funda.to_csv(os.path.join(directory, file_name))
+    @Instrumentation.stage()
+    def update_funda(store, wrds_connection, end_date, sql_features=False):
+        """Append filings not yet in the store, scoring them against each cusip's stored history."""
+        # Filings reach Compustat weeks after their datadate, so look back past the high-water mark
+        # and keep only the (cusip, datadate) pairs the store doesn't have yet
+        window_start = store.max_date('funda') - pd.Timedelta(days=FUNDA_REVISION_WINDOW_DAYS)
+        if sql_features:
+            # The database computes the lags from each cusip's whole filing history
+            downloaded = wrds_connection.download_factor_inputs(f'{window_start:%Y-%m-%d}', end_date)
+        else:
+            downloaded = wrds_connection.download_fundamental_data(f'{window_start:%Y-%m-%d}', end_date)
+        downloaded['datadate'] = pd.to_datetime(downloaded['datadate'])
+        stored_keys = store.read('funda', columns=['cusip', 'datadate'], start_date=window_start)
+        new_filings = downloaded.merge(stored_keys, on=['cusip', 'datadate'], how='left', indicator=True)
+        new_filings = new_filings[new_filings['_merge'] == 'left_only'].drop(columns=['_merge'])
+        if new_filings.empty:
+            print("No new filings")
+            return
+        if sql_features:
+            store.append('funda', DataHandler.add_piotroski_column_to_lagged_funda(new_filings))
+            return
+
+        # Only cusips with new filings are rescored, with their stored rows supplying the lags
+        cusips = new_filings['cusip'].dropna().unique().tolist()
+        history = store.read('funda', columns=list(downloaded.columns), filters=[('cusip', 'in', cusips)])
+        funda = pd.concat([history.assign(new_filing=False), new_filings.assign(new_filing=True)], ignore_index=True)
+        funda = DataHandler.add_piotroski_column_to_funda(funda)
+        store.append('funda', funda[funda['new_filing']].drop(columns=['new_filing']))
+
+    @staticmethod
+    @Instrumentation.stage()
+    def update_crsp(store, wrds_connection, end_date):
+        """Append CRSP trading days after the stored high-water mark, one month at a time."""
+        first_new_date = store.max_date('crsp') + pd.Timedelta(days=1)
+        if first_new_date > pd.Timestamp(end_date):
+            print("No new trading days")
+            return
+        for chunk_start, chunk_end in WRDSConnection.month_chunks(first_new_date, end_date):
+            crsp = wrds_connection.download_crsp_data(f'{chunk_start:%Y-%m-%d}', f'{chunk_end:%Y-%m-%d}')
+            store.append('crsp', crsp)
 
     @staticmethod
+    @Instrumentation.stage()
     def add_piotroski_column_to_funda(df):
-        print("Calculating Piotroski scores")
-        return df.groupby('cusip').apply(DataHandler.calculate_piotroski).reset_index(drop=True)
+        """Add the Piotroski score and the other registered factors, see FactorEngine."""
+        print("Calculating factor scores")
+        return FactorEngine.score(df)
+
+    @staticmethod
+    @Instrumentation.stage()
+    def add_piotroski_column_to_lagged_funda(df):
+        """add_piotroski_column_to_funda for funda downloaded with its lags, see download_factor_inputs."""
+        print("Calculating factor scores")
+        return FactorEngine.score_lagged(df)
 
-    # Process Fundamental Data to Calculate Piotroski Score
+    # Per-cusip reference implementation, kept to check FactorEngine's Piotroski scores against
     @staticmethod
     def calculate_piotroski(df):
         df['roa'] = df['ni'] / df['at'].shift(1)
@@ -70,107 +191,118 @@ class DataHandler:
         return df
 
     @staticmethod
-    def read_data(funda_file_path, crsp_file_path):
-        """Read the fundamental and CRSP data from CSV files."""
+    @Instrumentation.stage()
+    def read_data(store, start_date, end_date):
+        """Read the fundamental and CRSP data from the store, loading only CRSP partitions inside the date window.
+        CUSIPs are replaced by security ids from the returned SecurityMaster."""
         print("Loading data")
-        funda = pd.read_csv(funda_file_path)
-        crsp = pd.read_csv(crsp_file_path)
-        return funda, crsp
+        # Funda downloaded with sql_features carries its market cap snapshot. Stores downloaded before a factor
+        # was registered don't have its column until they are downloaded again
+        stored_columns = store.stored_schema('funda').names
+        funda_columns = [column for column in FUNDA_COLUMNS + FactorEngine.columns() + ['market_cap']
+                         if column in stored_columns]
+        # Filings after the window or without a ticker never survive prepare_funda, so they aren't read. Earlier
+        # filings are, they tell which filing is each ticker's first
+        funda = (QueryPlan.scan_store(store, 'funda', columns=funda_columns, dictionary_columns=['cusip'])
+                 .drop_nulls(['tic']).filter('datadate', '<=', pd.Timestamp(end_date)).collect())
+        crsp = store.read('crsp', columns=CRSP_COLUMNS, start_date=start_date, end_date=end_date,
+                          dictionary_columns=['cusip'])
+        security_master = SecurityMaster.from_columns(funda['cusip'], crsp['cusip'])
+        funda = security_master.encode(funda)
+        crsp = security_master.encode(crsp).astype(CRSP_DTYPES, copy=False)
+        return funda, crsp, security_master
 
     @staticmethod
-    def clean_funda(funda, start_date, end_date, market_cap_threshold, crsp):
-        """Clean the funda DataFrame by removing duplicates, filtering missing years, and cleaning CUSIP."""
-        print("Cleaning funda dataframe")
-        funda = DataHandler.standardize_date(funda, 'datadate')
-        funda = DataHandler.drop_first_year_of_each_ticker(funda)
-        funda = DataHandler.filter_time_range(funda, "datadate", start_date, end_date)
-        funda = DataHandler.filter_duplicates(funda)
-        funda = DataHandler.filter_missing_years(funda)
-        funda = DataHandler.standardize_cusips(funda, 'cusip')
-        funda = DataHandler.filter_funda_by_market_cap(funda, market_cap_threshold, crsp)
-        funda = funda.sort_values('datadate')
+    @Instrumentation.stage()
+    def clean_funda(funda, start_date, end_date, market_cap_threshold, crsp, market_cap_index=None):
+        """Clean the funda DataFrame by removing duplicates, filtering missing years, and cleaning CUSIP.
+        Market caps come from market_cap_index when given, otherwise an index is built from crsp."""
+        funda = DataHandler.prepare_funda(funda, start_date, end_date)
+        funda = DataHandler.filter_funda_by_market_cap(funda, market_cap_threshold, crsp, market_cap_index)
+        funda = funda.sort_values('datadate', kind='mergesort')
         return funda
 
     @staticmethod
-    def clean_crsp(crsp, start_date, end_date):
-        """Clean the crsp DataFrame by ensuring CUSIPs are 8 character long strings."""
-        print("Cleaning crsp dataframe")
-        crsp = DataHandler.standardize_date(crsp, 'date')
-        crsp = DataHandler.filter_time_range(crsp, "date", start_date, end_date)
-        crsp = DataHandler.standardize_cusips(crsp, 'cusip')
-        return crsp
-
-    @staticmethod
-    def filter_duplicates(df):
-        """Remove duplicate rows with identical 'cusip', 'datadate'"""
-        return df.drop_duplicates(subset=['cusip', 'datadate']).reset_index(drop=True)
-
-    @staticmethod
-    def filter_missing_years(df):
-        """Filters out rows with missing values in columns used to calculate score."""
-        return df.dropna(subset=['roa', 'cfo', 'delta_leverage', 'delta_margin', 'delta_turn'])
+    @Instrumentation.stage()
+    def prepare_funda(funda, start_date, end_date):
+        """The cleaning steps of clean_funda that don't depend on the market cap threshold, run as one query plan."""
+        print("Cleaning funda dataframe")
+        return DataHandler.funda_cleaning_plan(QueryPlan.scan_frame(funda), start_date, end_date).collect()
 
     @staticmethod
-    def standardize_cusips(df, cusip_column):
-        """Ensure that the CUSIP column contains strings of 8 characters, trimming and formatting as necessary."""
-        df[cusip_column] = df[cusip_column].astype(str).str.strip()  # Converts CUSIP codes into strings and trims spaces
-        df[cusip_column] = df[cusip_column].str[:8]  # Keeps first 8 characters
-        #TODO: Check matching with cusip codes longer than 8 digits.
-        return df
+    def funda_cleaning_plan(plan, start_date, end_date):
+        """Drop the first year of each ticker, whose factor lags are missing, then the rows outside the window,
+        duplicate (security_id, datadate) rows, rows missing a score input and rows without a security id."""
+        return (plan.parse_dates('datadate')
+                .drop_first('tic', 'datadate')
+                .filter_range('datadate', start_date, end_date)
+                .drop_duplicates(['security_id', 'datadate'])
+                .drop_nulls(SCORE_INPUT_COLUMNS)
+                .filter('security_id', '>=', 0))
 
     @staticmethod
-    def standardize_date(df, date_column):
-        """Ensure that the date column contains datetime objects."""
-        df[date_column] = pd.to_datetime(df[date_column], errors='coerce')  # Coerce invalid dates to NaT
-        return df
+    @Instrumentation.stage()
+    def clean_crsp(crsp):
+        """Clean the crsp DataFrame by ensuring dates are datetimes and every row has a security id.
+        The date window is applied when the data is read from the store."""
+        print("Cleaning crsp dataframe")
+        return QueryPlan.scan_frame(crsp).parse_dates('date').filter('security_id', '>=', 0).collect()
 
     @staticmethod
-    def drop_first_year_of_each_ticker(funda):
-        """Drop the earliest row for each ticker (tic) in the funda DataFrame."""
-        # Sort by 'datadate' to ensure the earliest dates are at the top for each 'tic'
-        funda = funda.sort_values(by=['tic', 'datadate'])
-        # Drop the first occurrence of each 'tic' and keep the rest
-        funda = funda.groupby('tic').apply(lambda x: x.iloc[1:]).reset_index(drop=True)
-        return funda
+    @Instrumentation.stage()
+    def filter_funda_by_market_cap(funda, market_cap_threshold, crsp, market_cap_index=None):
+        """Filter funda based on market cap threshold using values from crsp on the closest available date."""
+        funda = DataHandler.attach_market_cap(funda, crsp, market_cap_index)
+        filtered_funda = DataHandler.apply_market_cap_threshold(funda, market_cap_threshold)
+        return filtered_funda
 
     @staticmethod
-    def filter_time_range(funda, column_name, start_date, end_date):
-        return funda[(funda[column_name] >= start_date) & (funda[column_name] <= end_date)].copy()
+    @Instrumentation.stage()
+    def attach_market_cap(funda, crsp, market_cap_index=None):
+        """Add the market cap on the closest crsp date on or before each datadate, ordering funda by datadate.
+        Funda downloaded with sql_features already has it."""
+        if 'market_cap' in funda.columns:
+            return funda.sort_values('datadate', kind='mergesort')
+        if market_cap_index is None:
+            market_cap_index = DataHandler.build_market_cap_index(crsp)
+        return DataHandler.look_up_market_caps(funda, market_cap_index)
 
     @staticmethod
-    def filter_funda_by_market_cap(funda, market_cap_threshold, crsp):
-        """Filter funda based on market cap threshold using values from crsp on the closest available date."""
+    @Instrumentation.stage()
+    def build_market_cap_index(crsp):
+        """As-of index of every security's daily market cap, built once and shared by the filing date filter
+        and the backtest's daily eligibility check."""
         # Calculate market cap in crsp data
         crsp = DataHandler.calculate_market_cap(crsp)
-        funda = DataHandler.merge_funda_with_crsp(funda, crsp)
-        filtered_funda = DataHandler.apply_market_cap_threshold(funda, market_cap_threshold)
-        return filtered_funda
+        return AsOfIndex.from_columns(crsp['security_id'], crsp['date'], crsp['market_cap'])
 
     @staticmethod
+    @Instrumentation.stage()
     def calculate_market_cap(crsp):
         """Calculate market cap in the crsp DataFrame."""
-        crsp['market_cap'] = crsp['prc'] * crsp['shrout'] * 1000  # shrout is in thousands
+        crsp['market_cap'] = crsp['prc'] * crsp['shrout'] * np.float32(1000)  # shrout is in thousands
         return crsp
 
     @staticmethod
+    @Instrumentation.stage()
     def merge_funda_with_crsp(funda, crsp):
         """Merge funda with crsp to get market cap on the closest date for each datadate in funda."""
-        funda['datadate'] = pd.to_datetime(funda['datadate'])
         crsp['date'] = pd.to_datetime(crsp['date'])
+        market_cap_index = AsOfIndex.from_columns(crsp['security_id'], crsp['date'], crsp['market_cap'])
+        return DataHandler.look_up_market_caps(funda, market_cap_index)
 
-        # Merge on 'cusip' and closest date prior to or on 'datadate'.
-        # Sometimes 'datadate' is on the weekend so this is necessary.
-        merged_funda = pd.merge_asof(
-            funda.sort_values('datadate'),
-            crsp[['cusip', 'date', 'market_cap']].sort_values('date'),
-            left_on='datadate',
-            right_on='date',
-            by='cusip',
-            direction='backward'
-        )
-        return merged_funda
+    @staticmethod
+    @Instrumentation.stage()
+    def look_up_market_caps(funda, market_cap_index):
+        """Add the market cap of each row's security on the closest date on or before its datadate."""
+        funda['datadate'] = pd.to_datetime(funda['datadate'])
+        funda = funda.sort_values('datadate', kind='mergesort').reset_index(drop=True)
+        # The closest date prior to or on 'datadate', sometimes 'datadate' is on the weekend so this is necessary.
+        funda['market_cap'] = market_cap_index.as_of(funda['security_id'].to_numpy(), funda['datadate'].to_numpy())
+        return funda
 
     @staticmethod
+    @Instrumentation.stage()
     def apply_market_cap_threshold(funda, market_cap_threshold):
         """Filter rows in funda where market cap meets or exceeds the threshold."""
-        return funda[funda['market_cap'] >= market_cap_threshold].drop(columns=['date'])
\ No newline at end of file
+        return funda[funda['market_cap'] >= market_cap_threshold].drop(columns=['date'], errors='ignore')
\ No newline at end of file
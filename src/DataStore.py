@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PARTITION_COLUMN = 'year'
+# Leading underscore keeps the manifest out of Parquet dataset discovery
+MANIFEST_FILE = '_manifest.json'
+
+# Explicit storage types; columns not listed keep the type Arrow infers from pandas
+SCHEMAS = {
+    'funda': {
+        'gvkey': pa.string(), 'datadate': pa.timestamp('ns'), 'fyear': pa.float64(), 'fic': pa.string(),
+        'tic': pa.string(), 'cusip': pa.string(),
+        'at': pa.float64(), 'lt': pa.float64(), 'pstkl': pa.float64(), 'txditc': pa.float64(),
+        'pstkrv': pa.float64(), 'aco': pa.float64(), 'lco': pa.float64(), 'csho': pa.float64(),
+        'txdb': pa.float64(), 'pstk': pa.float64(), 'ni': pa.float64(), 'oancf': pa.float64(),
+        'dltt': pa.float64(), 'mkvalt': pa.float64(), 'ebit': pa.float64(), 'dlc': pa.float64(),
+        'ivst': pa.float64(), 'che': pa.float64(), 're': pa.float64(), 'sale': pa.float64(),
+        'cogs': pa.float64(), 'xsga': pa.float64(), 'xint': pa.float64(), 'xrd': pa.float64(),
+        'dp': pa.float64(), 'Score': pa.int8(), 'market_cap': pa.float64(),
+    },
+    'crsp': {
+        'permno': pa.int32(), 'date': pa.timestamp('ns'), 'ret': pa.float32(), 'prc': pa.float32(),
+        'shrout': pa.float32(), 'cusip': pa.string(),
+    },
+}
+
+# Column each table is partitioned on, by calendar year
+DATE_COLUMNS = {'funda': 'datadate', 'crsp': 'date'}
+
+
+class DataStore:
+    """Parquet tables under a root directory, each partitioned by year as <root>/<table>/year=YYYY/."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def table_path(self, table_name):
+        return os.path.join(self.root, table_name)
+
+    def exists(self, table_name):
+        return os.path.isdir(self.table_path(table_name))
+
+    def write(self, table_name, df):
+        """Replace a table with df. The new table is built beside the old one and swapped in at the end."""
+        print(f"Saving {table_name} to {self.table_path(table_name)}")
+        os.makedirs(self.root, exist_ok=True)
+        staging_path = os.path.join(self.root, f'.{table_name}.staging')
+        shutil.rmtree(staging_path, ignore_errors=True)
+        table = self.to_arrow(table_name, df)
+        years = pc.year(table[DATE_COLUMNS[table_name]]).cast(pa.int32())
+        self.write_partitions(staging_path, table.append_column(PARTITION_COLUMN, years))
+        self.swap_in(table_name, staging_path)
+
+    def append(self, table_name, df):
+        """Add rows to an existing table as one new file per year. Each file is renamed into place only once
+        fully written, oldest year first, so the table's high-water mark never runs ahead of its data."""
+        if df.empty:
+            return
+        print(f"Appending {len(df):,} rows to {self.table_path(table_name)}")
+        schema = self.stored_schema(table_name)
+        table = self.to_arrow(table_name, df).select(schema.names).cast(schema)
+        years = pc.year(table[DATE_COLUMNS[table_name]])
+        for year in sorted(pc.unique(years).to_pylist()):
+            year_table = table.filter(pc.equal(years, year))
+            dates = year_table[DATE_COLUMNS[table_name]]
+            partition_path = os.path.join(self.table_path(table_name), f'{PARTITION_COLUMN}={year}')
+            os.makedirs(partition_path, exist_ok=True)
+            file_name = (f'append-{pc.min(dates).as_py():%Y%m%d}-{pc.max(dates).as_py():%Y%m%d}'
+                         f'-{uuid.uuid4().hex[:8]}.parquet')
+            self.write_file_atomically(year_table, partition_path, file_name)
+
+    def max_date(self, table_name):
+        """Latest date stored in a table, read from its newest year partition only."""
+        date_column = DATE_COLUMNS[table_name]
+        years = [int(entry.split('=')[1]) for entry in os.listdir(self.table_path(table_name))
+                 if entry.startswith(f'{PARTITION_COLUMN}=')]
+        table = pq.read_table(self.table_path(table_name), columns=[date_column], partitioning='hive',
+                              filters=[(PARTITION_COLUMN, '=', max(years))])
+        return pd.Timestamp(pc.max(table[date_column]).as_py())
+
+    def stored_schema(self, table_name):
+        """Schema of the table's files, without the partition key."""
+        schema = ds.dataset(self.table_path(table_name), format='parquet', partitioning='hive').schema
+        return schema.remove(schema.get_field_index(PARTITION_COLUMN))
+
+    def begin_chunked_write(self, table_name, chunk_keys):
+        """Start, or resume, a chunk-by-chunk rebuild of a table. Returns the chunk keys still to be written.
+
+        Chunks go to a staging directory with a manifest of finished chunks, so an interrupted rebuild
+        picks up where it stopped as long as it is resumed with the same chunks."""
+        staging_path = os.path.join(self.root, f'.{table_name}.staging')
+        manifest = self.read_manifest(staging_path)
+        if manifest is None or manifest['chunks'] != list(chunk_keys):
+            shutil.rmtree(staging_path, ignore_errors=True)
+            os.makedirs(staging_path)
+            manifest = {'chunks': list(chunk_keys), 'completed': []}
+            self.write_manifest(staging_path, manifest)
+        elif manifest['completed']:
+            print(f"Resuming {table_name} download, "
+                  f"{len(manifest['completed'])}/{len(chunk_keys)} chunks already saved")
+        return [key for key in chunk_keys if key not in set(manifest['completed'])]
+
+    def write_chunk(self, table_name, chunk_key, df):
+        """Write one chunk, all within a single year, to the staging table and mark it finished."""
+        staging_path = os.path.join(self.root, f'.{table_name}.staging')
+        if not df.empty:
+            table = self.to_arrow(table_name, df)
+            year = pd.Timestamp(df[DATE_COLUMNS[table_name]].iloc[0]).year
+            partition_path = os.path.join(staging_path, f'{PARTITION_COLUMN}={year}')
+            os.makedirs(partition_path, exist_ok=True)
+            self.write_file_atomically(table, partition_path, f'{chunk_key}.parquet')
+
+        manifest = self.read_manifest(staging_path)
+        manifest['completed'].append(chunk_key)
+        self.write_manifest(staging_path, manifest)
+
+    def finish_chunked_write(self, table_name):
+        """Swap a completed chunked rebuild in as the live table."""
+        self.swap_in(table_name, os.path.join(self.root, f'.{table_name}.staging'))
+
+    @staticmethod
+    def write_file_atomically(table, directory, file_name):
+        # The dot prefix hides a half-written file from dataset discovery until it is renamed
+        temporary_path = os.path.join(directory, f'.{file_name}.tmp')
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, os.path.join(directory, file_name))
+
+    @staticmethod
+    def read_manifest(table_path):
+        manifest_path = os.path.join(table_path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    @staticmethod
+    def write_manifest(table_path, manifest):
+        manifest_path = os.path.join(table_path, MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def read(self, table_name, columns=None, start_date=None, end_date=None, filters=None, dictionary_columns=None,
+             not_null=None):
+        """Load a table, reading only the requested columns and the partitions overlapping the date window.
+        Extra filters use the pyarrow tuple form, e.g. [('cusip', 'in', cusips)], and rows with a null in any
+        of the not_null columns are skipped. dictionary_columns are loaded as pandas categoricals, without
+        building a string object per row."""
+        date_column = DATE_COLUMNS[table_name]
+        filters = list(filters or [])
+        if start_date is not None:
+            start_date = pd.Timestamp(start_date)
+            filters += [(PARTITION_COLUMN, '>=', start_date.year), (date_column, '>=', start_date)]
+        if end_date is not None:
+            end_date = pd.Timestamp(end_date)
+            filters += [(PARTITION_COLUMN, '<=', end_date.year), (date_column, '<=', end_date)]
+
+        filters = filters or None
+        if not_null:
+            # The tuple form has no null test, so the filters become an expression the null tests are added to
+            filters = pq.filters_to_expression(filters) if filters else None
+            for column in not_null:
+                is_valid = pc.field(column).is_valid()
+                filters = is_valid if filters is None else filters & is_valid
+        table = pq.read_table(self.table_path(table_name), columns=columns, filters=filters,
+                              partitioning='hive', memory_map=True, read_dictionary=dictionary_columns)
+        if PARTITION_COLUMN in table.column_names and (columns is None or PARTITION_COLUMN not in columns):
+            table = table.drop_columns([PARTITION_COLUMN])
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def to_arrow(self, table_name, df):
+        """Convert df to Arrow, sorted by date and with known columns cast to the table schema."""
+        date_column = DATE_COLUMNS[table_name]
+        dates = pd.to_datetime(df[date_column], errors='coerce')
+        # Rows without a valid date have no partition to live in
+        df = df.assign(**{date_column: dates})[dates.notna()].sort_values(date_column, kind='mergesort')
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        schema = SCHEMAS[table_name]
+        return table.cast(pa.schema([
+            pa.field(field.name, schema.get(field.name, field.type)) for field in table.schema
+        ]))
+
+    @staticmethod
+    def write_partitions(path, table):
+        pq.write_to_dataset(table, path, partition_cols=[PARTITION_COLUMN], row_group_size=1_000_000)
+
+    def swap_in(self, table_name, staging_path):
+        """Move a fully written staging directory into place, then discard the previous table."""
+        path = self.table_path(table_name)
+        retired_path = os.path.join(self.root, f'.{table_name}.retired')
+        shutil.rmtree(retired_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, retired_path)
+        os.replace(staging_path, path)
+        shutil.rmtree(retired_path, ignore_errors=True)
@@ -0,0 +1,116 @@
+import numpy as np
+
+from src.FundamentalFactors import FundamentalFactors, ALTMAN_Z_INPUTS
+from src.PiotroskiEngine import PiotroskiEngine, PIOTROSKI_INPUTS, PIOTROSKI_LAGS, PIOTROSKI_LEVELS
+
+
+class Factor:
+    """A fundamental factor: the funda columns it reads, how many prior filings of each it needs, and the
+    function computing its output columns, compute(current, lagged) -> {column: values}. current maps each
+    input to its values and lagged maps (input, lag) to the values lag filings earlier of the same cusip."""
+
+    def __init__(self, name, inputs, lags, compute, column=None, levels=None):
+        self.name = name
+        self.inputs = list(inputs)
+        self.lags = dict(lags)  # {input: maximum lag}
+        self.compute = compute
+        self.column = column or name  # Output column portfolios are ranked on
+        self.levels = levels  # Number of integer values 0..levels-1 a discrete factor takes, None if continuous
+
+
+# Registered factors by name, computed in registration order
+FACTORS = {}
+
+
+class FactorEngine:
+    """Computes every registered factor in one pass over funda sorted by cusip and datadate, with each lagged
+    input computed once and shared by all the factors that use it."""
+
+    @staticmethod
+    def register(factor):
+        FACTORS[factor.name] = factor
+        return factor
+
+    @staticmethod
+    def factors(names=None):
+        return [FACTORS[name] for name in (names or FACTORS)]
+
+    @staticmethod
+    def inputs(names=None):
+        """Input columns of the factors, each listed once."""
+        return list(dict.fromkeys(column for factor in FactorEngine.factors(names)
+                                  for column in factor.inputs + list(factor.lags)))
+
+    @staticmethod
+    def lags(names=None):
+        """(input, lag) pairs of every lagged input the factors need."""
+        max_lags = {}
+        for factor in FactorEngine.factors(names):
+            for column, max_lag in factor.lags.items():
+                max_lags[column] = max(max_lags.get(column, 0), max_lag)
+        return [(column, lag) for column, max_lag in max_lags.items() for lag in range(1, max_lag + 1)]
+
+    @staticmethod
+    def columns(names=None):
+        """The columns the factors are ranked on."""
+        return [factor.column for factor in FactorEngine.factors(names)]
+
+    @staticmethod
+    def levels(column):
+        """Number of levels of the discrete factor ranked on column, None for continuous factors and composites."""
+        return next((factor.levels for factor in FACTORS.values() if factor.column == column), None)
+
+    @staticmethod
+    def score(funda, names=None):
+        """Compute the named factors, all registered ones by default, for every cusip in one grouped pass."""
+        funda = funda[funda['cusip'].notna()]
+        funda = funda.sort_values(['cusip', 'datadate'], kind='mergesort').reset_index(drop=True)
+
+        # Position of each row inside its cusip block, used to mask lags that would cross firms
+        position = funda.groupby('cusip', sort=False).cumcount().to_numpy()
+        current = {column: funda[column].to_numpy(dtype='float64') for column in FactorEngine.inputs(names)}
+        lagged = {(column, lag): FactorEngine.lag(current[column], position, lag)
+                  for column, lag in FactorEngine.lags(names)}
+        return FactorEngine.add_factors(funda, current, lagged, names)
+
+    @staticmethod
+    def score_lagged(funda, names=None):
+        """Score rows that already carry their lags as <input>_lag<n> columns, e.g. computed by the database.
+        The lag columns are dropped once used."""
+        lag_columns = {(column, lag): FactorEngine.lag_column(column, lag) for column, lag in FactorEngine.lags(names)}
+        current = {column: funda[column].to_numpy(dtype='float64') for column in FactorEngine.inputs(names)}
+        lagged = {key: funda[lag_column].to_numpy(dtype='float64') for key, lag_column in lag_columns.items()}
+        return FactorEngine.add_factors(funda.drop(columns=list(lag_columns.values())), current, lagged, names)
+
+    @staticmethod
+    def add_factors(funda, current, lagged, names=None):
+        """Add the factors' output columns to funda, whose rows line up with current and lagged."""
+        for factor in FactorEngine.factors(names):
+            for column, values in factor.compute(current, lagged).items():
+                funda[column] = values
+        return funda
+
+    @staticmethod
+    def composite(funda, weights):
+        """Weighted sum of factor columns, e.g. {'Score': 1, 'asset_growth': -5}, to rank portfolios on a blend.
+        Rows missing any of the factors get NaN."""
+        return sum(weight * funda[column].astype('float64') for column, weight in weights.items())
+
+    @staticmethod
+    def lag_column(column, lag):
+        return f'{column}_lag{lag}'
+
+    @staticmethod
+    def lag(values, position, lag):
+        """Shift values down by lag rows, blanking rows whose lag would reach into the previous cusip."""
+        shifted = np.full(len(values), np.nan)
+        if lag < len(values):
+            shifted[lag:] = values[:-lag]
+        shifted[position < lag] = np.nan
+        return shifted
+
+
+FactorEngine.register(Factor('piotroski', PIOTROSKI_INPUTS, PIOTROSKI_LAGS, PiotroskiEngine.compute, column='Score',
+                             levels=PIOTROSKI_LEVELS))
+FactorEngine.register(Factor('altman_z', ALTMAN_Z_INPUTS, {}, FundamentalFactors.altman_z))
+FactorEngine.register(Factor('asset_growth', ['at'], {'at': 1}, FundamentalFactors.asset_growth))
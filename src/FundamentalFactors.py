@@ -0,0 +1,25 @@
+import numpy as np
+
+ALTMAN_Z_INPUTS = ['at', 'lt', 're', 'ebit', 'mkvalt', 'sale', 'che', 'dlc']
+
+
+class FundamentalFactors:
+    """Factors besides Piotroski that are computed from the downloaded comp.funda columns."""
+
+    @staticmethod
+    def altman_z(current, lagged):
+        """Altman (1968) Z-score. The download has no total current assets or liabilities, so working capital
+        is taken as cash and short-term investments less debt in current liabilities."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            working_capital = current['che'] - current['dlc']
+            return {'altman_z': 1.2 * working_capital / current['at']
+                                + 1.4 * current['re'] / current['at']
+                                + 3.3 * current['ebit'] / current['at']
+                                + 0.6 * current['mkvalt'] / current['lt']
+                                + 1.0 * current['sale'] / current['at']}
+
+    @staticmethod
+    def asset_growth(current, lagged):
+        """Growth of total assets over the previous filing."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {'asset_growth': current['at'] / lagged[('at', 1)] - 1}
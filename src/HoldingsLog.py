@@ -0,0 +1,270 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.Instrumentation import Instrumentation
+
+SIDES = ['long', 'short']
+SCHEMA = pa.schema([
+    ('rebalance_date', pa.timestamp('ns')),
+    ('security_id', pa.int32()),
+    ('cusip', pa.dictionary(pa.int32(), pa.string())),
+    ('tic', pa.dictionary(pa.int32(), pa.string())),
+    ('side', pa.dictionary(pa.int8(), pa.string())),
+    ('score', pa.float64()),
+    ('entry_date', pa.timestamp('ns')),
+    ('exit_date', pa.timestamp('ns')),
+])
+# security_id of the row recording a rebalance that left both portfolios empty, the id of a missing CUSIP
+NO_SECURITY = -1
+# Rows buffered before they are written out, each flush becomes one Parquet row group
+BATCH_SIZE = 100_000
+
+
+class HoldingsLog:
+    """The portfolios built at each rebalance, one (rebalance_date, security_id, cusip, tic, side, score,
+    entry_date, exit_date) row per holding. A holding dropped for inactivity before the next rebalance gets a
+    second row, a copy with the exit_date set, and a rebalance that leaves both portfolios empty gets a single
+    row with security_id NO_SECURITY and no side. Rows are buffered in columnar arrays and flushed in batches,
+    to a Parquet file while the run progresses when a path is given, otherwise to Arrow tables kept in memory.
+
+    A file is written as segments, each finished when the runner checkpoints, and the segments are combined
+    into the file on close(). Rows are recorded in rebalance date order, so reading a date window only touches
+    the row groups overlapping it."""
+
+    def __init__(self, path=None, tickers=None, security_master=None, batch_size=BATCH_SIZE):
+        # tickers maps security_id to tic, e.g. a Series indexed by security id, and security_master decodes
+        # security ids to CUSIPs. tic and cusip are left empty without them
+        self.path = path
+        self.batch_size = batch_size
+        self.tic_by_id = self.tic_lookup(tickers)
+        self.cusip_by_id = (security_master.cusips.to_numpy(dtype=object) if security_master is not None
+                            else np.array([], dtype=object))
+        self.buffer = {column: [] for column in
+                       ['rebalance_date', 'security_id', 'side', 'score', 'entry_date', 'exit_date']}
+        self.buffered_rows = 0
+        self.rebalance_date = None  # Latest rebalance, the one exits are recorded against
+        self.tables = []
+        self.segments = []  # Finished segment files, in order
+        # {segment: id_map} for segments written with other security ids, id_map[written id] being this run's
+        self.segment_id_maps = {}
+        self.writer = None
+        self.closed = False
+
+    @classmethod
+    def open(cls, path):
+        """A log over a file saved by an earlier run, for reading."""
+        log = cls(path)
+        log.segments = [path]
+        log.closed = True
+        return log
+
+    @staticmethod
+    def tic_lookup(tickers):
+        """Array of tickers indexed by security id. A security listed under several tickers keeps the last."""
+        if tickers is None or len(tickers) == 0:
+            return np.array([], dtype=object)
+        tickers = tickers[tickers.index >= 0]
+        tic_by_id = np.full(int(tickers.index.max()) + 1, None, dtype=object)
+        tic_by_id[tickers.index.to_numpy()] = tickers.to_numpy()
+        return tic_by_id
+
+    def record_rebalance(self, rebalance_date, long_portfolio, short_portfolio):
+        """Add the portfolios, {security_id: {'score': ..., 'entry_date': ...}}, built on rebalance_date."""
+        if self.closed:
+            raise ValueError("Holdings log is closed")
+        self.rebalance_date = rebalance_date
+        if not long_portfolio and not short_portfolio:
+            self.append({'rebalance_date': [rebalance_date], 'security_id': [NO_SECURITY], 'side': [-1],
+                         'score': [np.nan], 'entry_date': [None], 'exit_date': [None]})
+            return
+        for side, portfolio in (('long', long_portfolio), ('short', short_portfolio)):
+            self.record_holdings(side, portfolio)
+
+    def record_exits(self, side, holdings):
+        """Add the holdings dropped from the side's portfolio since the latest rebalance, {security_id: {'score':
+        ..., 'entry_date': ..., 'exit_date': ...}}, exit_date being the first day they are no longer held."""
+        if self.closed:
+            raise ValueError("Holdings log is closed")
+        self.record_holdings(side, holdings, exits=True)
+
+    def record_holdings(self, side, holdings, exits=False):
+        if not holdings:
+            return
+        infos = holdings.values()
+        self.append({
+            'rebalance_date': [self.rebalance_date] * len(holdings),
+            'security_id': list(holdings),
+            'side': [SIDES.index(side)] * len(holdings),
+            'score': [info['score'] for info in infos],
+            'entry_date': [info['entry_date'] for info in infos],
+            'exit_date': [info['exit_date'] for info in infos] if exits else [None] * len(holdings),
+        })
+
+    def append(self, rows):
+        """Buffer rows given as {column: list of values}, flushing once the batch is full."""
+        self.buffer['rebalance_date'].append(self.dates(rows['rebalance_date']))
+        self.buffer['security_id'].append(np.array(rows['security_id'], dtype='int32'))
+        self.buffer['side'].append(np.array(rows['side'], dtype='int8'))
+        self.buffer['score'].append(np.array(rows['score'], dtype='float64'))
+        self.buffer['entry_date'].append(self.dates(rows['entry_date']))
+        self.buffer['exit_date'].append(self.dates(rows['exit_date']))
+        self.buffered_rows += len(rows['security_id'])
+        if self.buffered_rows >= self.batch_size:
+            self.flush()
+
+    @staticmethod
+    def dates(values):
+        return np.array([np.datetime64(pd.Timestamp(value), 'ns') if value is not None else np.datetime64('NaT', 'ns')
+                         for value in values], dtype='datetime64[ns]')
+
+    @staticmethod
+    def decode(lookup, security_ids):
+        """Values of lookup at security_ids, None for ids it doesn't cover."""
+        values = np.full(len(security_ids), None, dtype=object)
+        known = (security_ids >= 0) & (security_ids < len(lookup))
+        values[known] = lookup[security_ids[known]]
+        return values
+
+    @Instrumentation.stage()
+    def flush(self):
+        """Write the buffered rows out as one batch."""
+        if not self.buffered_rows:
+            return
+        columns = {column: np.concatenate(chunks) for column, chunks in self.buffer.items()}
+        security_ids = columns['security_id']
+        # Ids only mean something to the run that assigned them, the file also carries the CUSIPs
+        table = pa.table({
+            'rebalance_date': columns['rebalance_date'],
+            'security_id': security_ids,
+            'cusip': pa.array(self.decode(self.cusip_by_id, security_ids), type=pa.string()).dictionary_encode(),
+            'tic': pa.array(self.decode(self.tic_by_id, security_ids), type=pa.string()).dictionary_encode(),
+            'side': pa.DictionaryArray.from_arrays(pa.array(columns['side'], mask=columns['side'] < 0), SIDES),
+            'score': columns['score'],
+            'entry_date': pa.array(columns['entry_date'], from_pandas=True),
+            'exit_date': pa.array(columns['exit_date'], from_pandas=True),
+        }).cast(SCHEMA)
+
+        if self.path is None:
+            self.tables.append(table)
+        else:
+            if self.writer is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self.writer = pq.ParquetWriter(self.segment_path() + '.tmp', SCHEMA)
+            self.writer.write_table(table)
+        self.buffer = {column: [] for column in self.buffer}
+        self.buffered_rows = 0
+
+    def finish_segment(self):
+        """Flush and finish the segment being written, so everything recorded so far is safely on disk."""
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.replace(self.segment_path() + '.tmp', self.segment_path())
+            self.segments.append(self.segment_path())
+
+    def segment_path(self):
+        directory, file_name = os.path.split(self.path)
+        return os.path.join(directory, f'.{file_name}.{len(self.segments)}.segment')
+
+    def close(self):
+        """Flush the remaining rows and, for a file, combine its segments into it. Nothing can be recorded
+        afterwards."""
+        if self.closed:
+            return
+        self.finish_segment()
+        self.closed = True
+        if self.path is None or (self.segments == [self.path] and not self.segment_id_maps):
+            return
+        # Written beside the file and renamed into place, the file may itself be the first segment of a resumed log
+        directory, file_name = os.path.split(self.path)
+        os.makedirs(directory or '.', exist_ok=True)
+        temporary_path = os.path.join(directory, f'.{file_name}.tmp')
+        with pq.ParquetWriter(temporary_path, SCHEMA) as writer:
+            for segment in self.segments:
+                segment_file = pq.ParquetFile(segment)
+                for row_group in range(segment_file.num_row_groups):
+                    table = segment_file.read_row_group(row_group)
+                    if segment in self.segment_id_maps:
+                        table = self.remap(table, self.segment_id_maps[segment])
+                    writer.write_table(table)
+        os.replace(temporary_path, self.path)
+        for segment in self.segments:
+            if segment != self.path:
+                os.remove(segment)
+        self.segments = [self.path]
+        self.segment_id_maps = {}
+
+    def checkpoint(self):
+        """State to restore() the log to everything recorded so far, after a restart."""
+        self.finish_segment()
+        return {'segments': list(self.segments), 'tables': list(self.tables), 'rebalance_date': self.rebalance_date,
+                'segment_id_maps': dict(self.segment_id_maps)}
+
+    def restore(self, state, id_map=None):
+        """Continue a log from a checkpoint(), dropping whatever was recorded after it. id_map moves the rows
+        recorded so far to new security ids, id_map[old id], segments being remapped when they are combined."""
+        self.segments = list(state['segments'])
+        self.tables = list(state['tables'])
+        self.segment_id_maps = dict(state['segment_id_maps'])
+        if id_map is not None:
+            self.tables = [self.remap(table, id_map) for table in self.tables]
+            for segment in self.segments:
+                written_map = self.segment_id_maps.get(segment)
+                self.segment_id_maps[segment] = id_map if written_map is None else id_map[written_map]
+        self.rebalance_date = state['rebalance_date']
+        self.buffer = {column: [] for column in self.buffer}
+        self.buffered_rows = 0
+        self.writer = None
+        self.closed = False
+
+    @staticmethod
+    def remap(table, id_map):
+        """table with its security ids replaced by id_map[security_id], NO_SECURITY rows left as they are."""
+        security_ids = table['security_id'].to_numpy()
+        remapped = np.where(security_ids >= 0, np.asarray(id_map)[np.maximum(security_ids, 0)], security_ids)
+        return table.set_column(table.schema.get_field_index('security_id'), 'security_id',
+                                pa.array(remapped, type=pa.int32()))
+
+    def read(self, start_date=None, end_date=None, columns=None):
+        """The rows of the rebalances from start_date to end_date, exits included, closing the log first."""
+        self.close()
+        filters = []
+        if start_date is not None:
+            filters.append(('rebalance_date', '>=', pd.Timestamp(start_date)))
+        if end_date is not None:
+            filters.append(('rebalance_date', '<=', pd.Timestamp(end_date)))
+
+        if self.path is not None:
+            table = pq.read_table(self.path, columns=columns, filters=filters or None)
+        else:
+            table = pa.concat_tables(self.tables) if self.tables else SCHEMA.empty_table()
+            for column, operator, value in filters:
+                compare = pc.greater_equal if operator == '>=' else pc.less_equal
+                table = table.filter(compare(table[column], pa.scalar(value, type=pa.timestamp('ns'))))
+            if columns is not None:
+                table = table.select(columns)
+        return table.to_pandas()
+
+    @staticmethod
+    def entries(holdings):
+        """The holdings as built at each rebalance, without the exit and empty rebalance rows."""
+        return holdings[holdings['exit_date'].isna() & (holdings['security_id'] != NO_SECURITY)]
+
+    def portfolio_at(self, date):
+        """The long and short holdings in effect on date: those built at the latest rebalance on or before it,
+        less the ones that exited by date."""
+        date = pd.Timestamp(date)
+        dates = self.read(end_date=date, columns=['rebalance_date'])['rebalance_date']
+        if dates.empty:
+            return SCHEMA.empty_table().to_pandas()
+        holdings = self.read(start_date=dates.max(), end_date=dates.max())
+        exits = holdings[holdings['exit_date'] <= date]
+        held = self.entries(holdings)
+        exited = pd.MultiIndex.from_frame(exits[['security_id', 'side']].astype(object))
+        return held[~pd.MultiIndex.from_frame(held[['security_id', 'side']].astype(object)).isin(exited)]
@@ -0,0 +1,176 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is then left out of the report
+    resource = None
+
+
+class Instrumentation:
+    """Per-stage wall time, CPU time, memory high-water mark and row counts for a pipeline run.
+
+    Stages are functions decorated with @Instrumentation.stage() or blocks wrapped in Instrumentation.measure().
+    Nested stages are recorded under their parent's path, e.g. 'DataHandler.clean_funda/DataHandler.prepare_funda',
+    and repeated calls of a stage are added up. While disabled, a decorated function costs one flag check."""
+
+    enabled = False
+    stages = {}  # {path: record}
+    stack = []
+    profiler = None  # 'cprofile' or 'pyinstrument'
+    profile_stages = set()
+    profilers = {}  # {stage name: profiler}
+    profiling = False
+    started = None
+
+    @staticmethod
+    def enable(profile_stages=(), profiler='cprofile'):
+        """Start recording. Stages named in profile_stages also run under cProfile or pyinstrument."""
+        Instrumentation.reset()
+        Instrumentation.enabled = True
+        Instrumentation.profiler = profiler
+        Instrumentation.profile_stages = set(profile_stages)
+        Instrumentation.started = pd.Timestamp.now().isoformat()
+
+    @staticmethod
+    def disable():
+        Instrumentation.enabled = False
+
+    @staticmethod
+    def reset():
+        Instrumentation.stages = {}
+        Instrumentation.stack = []
+        Instrumentation.profilers = {}
+        Instrumentation.profiling = False
+
+    @staticmethod
+    def stage(name=None):
+        """Decorator recording every call of a function as a stage, named after its qualified name by default.
+        rows_in is the length of the first DataFrame argument and rows_out that of the first DataFrame returned."""
+        def decorator(func):
+            stage_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not Instrumentation.enabled:
+                    return func(*args, **kwargs)
+                with Instrumentation.measure(stage_name, Instrumentation.row_count(args)) as measurement:
+                    result = func(*args, **kwargs)
+                    measurement['rows_out'] = Instrumentation.row_count((result,))
+                return result
+            return wrapper
+        return decorator
+
+    @staticmethod
+    @contextmanager
+    def measure(name, rows_in=None):
+        """Record the enclosed block as a stage. Set 'rows_out' on the yielded dict to report output rows."""
+        measurement = {'rows_out': None}
+        if not Instrumentation.enabled:
+            yield measurement
+            return
+
+        Instrumentation.stack.append(name)
+        path = '/'.join(Instrumentation.stack)
+        # Created on entry so the report lists parents before their children
+        record = Instrumentation.stages.setdefault(path, {
+            'stage': name, 'path': path, 'depth': path.count('/'), 'calls': 0, 'wall_seconds': 0.0,
+            'cpu_seconds': 0.0, 'peak_rss_mb': None, 'peak_rss_growth_mb': None, 'rows_in': None, 'rows_out': None,
+        })
+        profiler = Instrumentation.start_profiler(name)
+        peak_rss_before = Instrumentation.peak_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield measurement
+        finally:
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            if profiler is not None:
+                Instrumentation.stop_profiler(profiler)
+            peak_rss = Instrumentation.peak_rss_mb()
+            Instrumentation.stack.pop()
+
+            record['calls'] += 1
+            record['wall_seconds'] += wall_seconds
+            record['cpu_seconds'] += cpu_seconds
+            if peak_rss is not None:
+                record['peak_rss_mb'] = peak_rss
+                record['peak_rss_growth_mb'] = (record['peak_rss_growth_mb'] or 0) + peak_rss - peak_rss_before
+            for key, rows in (('rows_in', rows_in), ('rows_out', measurement['rows_out'])):
+                if rows is not None:
+                    record[key] = (record[key] or 0) + rows
+
+    @staticmethod
+    def start_profiler(name):
+        # Profilers can't nest, so a profiled stage inside another one runs unprofiled
+        if name not in Instrumentation.profile_stages or Instrumentation.profiling:
+            return None
+        profiler = Instrumentation.profilers.get(name)
+        if profiler is None:
+            if Instrumentation.profiler == 'pyinstrument':
+                from pyinstrument import Profiler
+                profiler = Profiler()
+            else:
+                profiler = cProfile.Profile()
+            Instrumentation.profilers[name] = profiler
+        if isinstance(profiler, cProfile.Profile):
+            profiler.enable()
+        else:
+            profiler.start()
+        Instrumentation.profiling = True
+        return profiler
+
+    @staticmethod
+    def stop_profiler(profiler):
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        else:
+            profiler.stop()
+        Instrumentation.profiling = False
+
+    @staticmethod
+    def row_count(values):
+        for value in values:
+            if isinstance(value, pd.DataFrame):
+                return len(value)
+            if isinstance(value, tuple):
+                return Instrumentation.row_count(value)
+        return None
+
+    @staticmethod
+    def peak_rss_mb():
+        """Highest resident set size the process has reached so far."""
+        if resource is None:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+    @staticmethod
+    def write_report(path):
+        """Write the recorded stages to a JSON report, and any stage profiles next to it."""
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        report = {
+            'started': Instrumentation.started,
+            'finished': pd.Timestamp.now().isoformat(),
+            'stages': list(Instrumentation.stages.values()),
+        }
+        with open(path, 'w') as report_file:
+            # NumPy scalars, e.g. row counts a stage took from an array, are written as plain numbers
+            json.dump(report, report_file, indent=2, default=lambda value: value.item())
+
+        for name, profiler in Instrumentation.profilers.items():
+            if isinstance(profiler, cProfile.Profile):
+                profiler.dump_stats(os.path.join(directory, f'{name}.prof'))
+            else:
+                with open(os.path.join(directory, f'{name}.html'), 'w') as profile_file:
+                    profile_file.write(profiler.output_html())
+        print(f"Run report saved to {path}")
@@ -0,0 +1,20 @@
+import os
+
+import numpy as np
+
+
+class MappedArrays:
+    """Base for indexes kept as flat NumPy arrays, the attributes named in ARRAYS, in the order the constructor
+    takes them. They are saved to a directory as one .npy file each and memory-mapped back, so several
+    processes share one copy."""
+
+    ARRAYS = []
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        return cls(*[np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in cls.ARRAYS])
@@ -0,0 +1,114 @@
+import itertools
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from tqdm import tqdm
+
+from src.AsOfIndex import AsOfIndex
+from src.CrspIndex import CrspIndex
+from src.DataHandler import DataHandler
+from src.FactorEngine import FactorEngine
+from src.ReturnAnalytics import ReturnAnalytics
+from src.StrategyRunner import StrategyRunner
+from src.WorkerData import WorkerData, shared_data
+
+PARAMETERS = ['long_portfolio_size', 'short_portfolio_size', 'inactivity_threshold', 'market_cap_threshold',
+              'portfolio_update_delay', 'ranking']
+
+
+class ParameterSweep:
+    def __init__(self, funda, crsp, start_date, end_date, composite_weights=None):
+        """Clean the data once for every combination. funda and crsp are as returned by fetch_or_read_data.
+        With composite_weights, e.g. {'Score': 1.0, 'altman_z': 0.5}, combinations can rank on 'composite'."""
+        self.start_date = start_date
+        self.end_date = end_date
+        funda = DataHandler.prepare_funda(funda, start_date, end_date)
+        # Market cap is attached once, each combination only applies its own threshold
+        self.market_cap_index = DataHandler.build_market_cap_index(crsp)
+        self.funda = DataHandler.attach_market_cap(funda, crsp, self.market_cap_index)
+        if composite_weights:
+            self.funda['composite'] = FactorEngine.composite(self.funda, composite_weights)
+        self.crsp_index = CrspIndex.from_crsp(DataHandler.clean_crsp(crsp))
+
+    @staticmethod
+    def grid(**parameter_values):
+        """Every combination of the given values, e.g. grid(long_portfolio_size=[10, 20], ...)."""
+        names = list(parameter_values)
+        return [dict(zip(names, values)) for values in itertools.product(*parameter_values.values())]
+
+    def run(self, combinations, workers=None):
+        """Run every combination across a process pool.
+
+        Returns a summary table with one row per combination, and the daily returns of all combinations
+        indexed by (combination, date). Workers memory-map the crsp and market cap indexes from a temporary
+        directory, so they are shared rather than copied into each process."""
+        for parameters in combinations:
+            ranking = parameters.get('ranking', 'Score')
+            if ranking not in self.funda.columns:
+                raise ValueError(f"No {ranking!r} column to rank on"
+                                 f"{', pass composite_weights to rank on it' if ranking == 'composite' else ''}")
+        shared_directory = tempfile.mkdtemp(prefix='parameter_sweep_')
+        try:
+            self.crsp_index.save(os.path.join(shared_directory, 'crsp_index'))
+            self.market_cap_index.save(os.path.join(shared_directory, 'market_cap_index'))
+            self.funda.to_pickle(os.path.join(shared_directory, 'funda.pkl'))
+            with ProcessPoolExecutor(max_workers=workers, initializer=ParameterSweep.load_shared_data,
+                                     initargs=(shared_directory, self.start_date, self.end_date)) as executor:
+                outcomes = list(tqdm(executor.map(ParameterSweep.run_combination, combinations),
+                                     total=len(combinations), desc="Running parameter sweep"))
+        finally:
+            shutil.rmtree(shared_directory, ignore_errors=True)
+
+        summary = pd.DataFrame([{**parameters, **statistics}
+                                for parameters, (statistics, _) in zip(combinations, outcomes)])
+        summary.index.name = 'combination'
+        returns = pd.concat({combination: daily_returns for combination, (_, daily_returns) in enumerate(outcomes)},
+                            names=['combination', 'date'])
+        return summary, returns
+
+    @staticmethod
+    def load_shared_data(shared_directory, start_date, end_date):
+        """Worker initializer, memory-maps the indexes saved by run() into the worker's shared_data."""
+        WorkerData.load_shared_data({
+            'crsp_index': CrspIndex.load(os.path.join(shared_directory, 'crsp_index')),
+            'market_cap_index': AsOfIndex.load(os.path.join(shared_directory, 'market_cap_index')),
+            'funda': pd.read_pickle(os.path.join(shared_directory, 'funda.pkl')),
+            'start_date': start_date,
+            'end_date': end_date,
+        })
+
+    @staticmethod
+    def run_combination(parameters):
+        funda = DataHandler.apply_market_cap_threshold(shared_data['funda'], parameters['market_cap_threshold'])
+        funda = funda.sort_values('datadate', kind='mergesort')
+        strategy_runner = StrategyRunner(funda, None, parameters['inactivity_threshold'],
+                                         parameters['long_portfolio_size'], parameters['short_portfolio_size'],
+                                         shared_data['start_date'], shared_data['end_date'],
+                                         parameters['portfolio_update_delay'], crsp_index=shared_data['crsp_index'],
+                                         market_cap_index=shared_data['market_cap_index'],
+                                         market_cap_threshold=parameters['market_cap_threshold'],
+                                         ranking=parameters.get('ranking', 'Score'))
+        strategy_runner.run_strategy(show_progress=False)
+        cumulative_strategy_returns = strategy_runner.process_returns().astype('float64')
+        daily_strategy_returns = strategy_runner.daily_strategy_returns.loc[cumulative_strategy_returns.index]
+        daily_strategy_returns = daily_strategy_returns.astype('float64')
+        return ParameterSweep.summarize(daily_strategy_returns, cumulative_strategy_returns), daily_strategy_returns
+
+    @staticmethod
+    def summarize(daily_strategy_returns, cumulative_strategy_returns):
+        """Final cumulative returns of each leg plus annualized statistics of the long-short leg."""
+        long_short = daily_strategy_returns['long_short'].to_numpy(dtype='float64') - 1
+        statistics = {name: values[0] for name, values in ReturnAnalytics.statistics(long_short[None, :]).items()}
+        cumulative_long_short = cumulative_strategy_returns['long_short']
+        return {
+            'long_cumulative_return': cumulative_strategy_returns['long'].iloc[-1],
+            'short_cumulative_return': cumulative_strategy_returns['short'].iloc[-1],
+            'long_short_cumulative_return': cumulative_long_short.iloc[-1],
+            'long_short_annual_return': statistics['annual_return'],
+            'long_short_annual_volatility': statistics['annual_volatility'],
+            'long_short_sharpe': statistics['sharpe'],
+            'long_short_max_drawdown': (cumulative_long_short / cumulative_long_short.cummax() - 1).min(),
+        }
@@ -0,0 +1,58 @@
+import numpy as np
+
+# Raw Compustat inputs and how many prior years of each are needed
+PIOTROSKI_INPUTS = ['ni', 'at', 'oancf', 'aco', 'lco', 'csho', 'dltt', 'sale', 'cogs']
+PIOTROSKI_LAGS = {'ni': 1, 'at': 2, 'aco': 1, 'lco': 1, 'csho': 1, 'dltt': 1, 'sale': 1, 'cogs': 1}
+
+# Signal name -> True if the signal scores a point when positive, False if when non-positive
+PIOTROSKI_SIGNALS = {
+    'roa': True,
+    'cfo': True,
+    'delta_roa': True,
+    'accrual': True,
+    'delta_offering': False,
+    'delta_liquid': True,
+    'delta_leverage': False,
+    'delta_margin': True,
+    'delta_turn': True,
+}
+
+
+# A Piotroski F-score is the number of signals that score a point
+PIOTROSKI_LEVELS = len(PIOTROSKI_SIGNALS) + 1
+
+
+class PiotroskiEngine:
+    """The Piotroski F-score as a factor, registered with FactorEngine, which does the lagging."""
+
+    @staticmethod
+    def compute(current, lagged):
+        """The nine signals, their flags and the F-score in the 'Score' column."""
+        signals = PiotroskiEngine.compute_signals(current, lagged)
+        flags = {}
+        score = np.zeros(len(current['at']), dtype='int8')
+        for name, positive in PIOTROSKI_SIGNALS.items():
+            flag = ((signals[name] > 0) if positive else (signals[name] <= 0)).astype('int8')
+            flags[f'f_{name}'] = flag
+            score += flag
+        return {**signals, 'Score': score, **flags}
+
+    @staticmethod
+    def compute_signals(current, lagged):
+        """Build the signal columns from current values and a {(column, lag): values} dictionary of lags."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            roa = current['ni'] / lagged[('at', 1)]
+            previous_roa = lagged[('ni', 1)] / lagged[('at', 2)]
+            cfo = current['oancf'] / lagged[('at', 1)]
+            return {
+                'roa': roa,
+                'cfo': cfo,
+                'delta_roa': roa - previous_roa,
+                'accrual': cfo - roa,
+                'delta_liquid': (current['aco'] / current['lco']) - (lagged[('aco', 1)] / lagged[('lco', 1)]),
+                'delta_offering': current['csho'] - lagged[('csho', 1)],
+                'delta_leverage': current['dltt'] / lagged[('at', 1)] - lagged[('dltt', 1)] / lagged[('at', 2)],
+                'delta_margin': (current['sale'] - current['cogs']) / current['sale']
+                                - (lagged[('sale', 1)] - lagged[('cogs', 1)]) / lagged[('sale', 1)],
+                'delta_turn': current['sale'] / current['at'] - lagged[('sale', 1)] / lagged[('at', 1)],
+            }
@@ -1,31 +1,176 @@
-import matplotlib.pyplot as plt
-import yfinance as yf
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# matplotlib and yfinance are imported only when a plot is drawn or a benchmark downloaded, which keeps them out of
+# the startup of runs that never plot
+BENCHMARK_TICKER = '^GSPC'
+BENCHMARK_CACHE_DIRECTORY = '../input_data/benchmarks'
+BENCHMARK_MAX_AGE = pd.Timedelta(days=1)  # A cache not covering the plotted dates is refreshed once it is this old
+MAX_POINTS = 1000  # Points drawn per line, about the plot's width in pixels, longer series are downsampled
+LINES = {'long': ('Long Portfolio', 'blue'), 'short': ('Short Portfolio', 'red'),
+         'long_short': ('Long-Short Portfolio', 'green')}
+
 
 class Plotter:
     @staticmethod
-    def plot_strategy_returns(cumulative_strategy_returns, start_date):
-        spy = yf.download('^GSPC', start=start_date,
-                          end=cumulative_strategy_returns.index.max())
-
-        # Calculate S&P 500 returns
-        spy['daily_return'] = spy['Close'].pct_change()
-        spy['cumulative_return'] = (1 + spy['daily_return']).cumprod()
-
-        plt.figure(figsize=(12, 6))
-        plt.plot(cumulative_strategy_returns.index, cumulative_strategy_returns['long'], label='Long Portfolio', color='blue')
-        plt.plot(cumulative_strategy_returns.index, cumulative_strategy_returns['short'], label='Short Portfolio', color='red')
-        plt.plot(cumulative_strategy_returns.index, cumulative_strategy_returns['long_short'], label='Long-Short Portfolio',
-                 color='green')
-        # Plot S&P 500 cumulative returns
-        plt.plot(spy.index, spy['cumulative_return'], label='S&P 500', color='orange', linestyle='--')
-
-        plt.title('Cumulative Returns of Long, Short, and Long-Short Portfolios vs Benchmark')
-        plt.xlabel('Date')
-        plt.ylabel('Cumulative Return')
-        plt.legend()
-        plt.grid(True)
-
-        plt.show()
-        print(f"long cum. ret. is : {cumulative_strategy_returns['long'][-1]}")
-        print(f"short cum. ret. is : {cumulative_strategy_returns['short'][-1]}")
-        print(f"long-short cum. ret. is : {cumulative_strategy_returns['long_short'][-1]}")
\ No newline at end of file
+    def plot_strategy_returns(cumulative_strategy_returns, start_date, output_path=None, benchmark=True):
+        """Plot the cumulative returns of each leg against the S&P 500. With an output_path the plot is rendered
+        to that file without a display, otherwise it is shown."""
+        benchmark_returns = None
+        if benchmark:
+            benchmark_returns = Plotter.benchmark_returns(start_date, cumulative_strategy_returns.index.max())
+
+        figure = Plotter.figure(interactive=output_path is None)
+        Plotter.draw_returns(figure.axes[0], cumulative_strategy_returns, benchmark_returns)
+        if output_path is None:
+            import matplotlib.pyplot as plt
+            plt.show()
+        else:
+            Plotter.save(figure, output_path)
+
+        print(f"long cum. ret. is : {cumulative_strategy_returns['long'].iloc[-1]}")
+        print(f"short cum. ret. is : {cumulative_strategy_returns['short'].iloc[-1]}")
+        print(f"long-short cum. ret. is : {cumulative_strategy_returns['long_short'].iloc[-1]}")
+
+    @staticmethod
+    def plot_sweep_returns(returns, output_directory, start_date=None, benchmark=True):
+        """Render one plot per parameter combination of a ParameterSweep run, from its daily returns indexed by
+        (combination, date), to <output_directory>/combination_<n>.png. One figure is reused for every plot."""
+        benchmark_returns = None
+        if benchmark and len(returns):
+            dates = returns.index.get_level_values('date')
+            benchmark_returns = Plotter.benchmark_returns(start_date or dates.min(), dates.max())
+
+        figure = Plotter.figure(interactive=False)
+        paths = []
+        for combination, daily_returns in returns.groupby(level='combination', sort=True):
+            cumulative_returns = daily_returns.droplevel('combination').astype('float64').cumprod()
+            figure.axes[0].clear()
+            Plotter.draw_returns(figure.axes[0], cumulative_returns, benchmark_returns,
+                                 title=f'Cumulative Returns of Combination {combination}')
+            paths.append(Plotter.save(figure, os.path.join(output_directory, f'combination_{combination}.png')))
+        return paths
+
+    @staticmethod
+    def figure(interactive):
+        """A figure with one axes. Figures rendered to files are built without pyplot, so they need no display
+        and leave pyplot's backend alone."""
+        if interactive:
+            import matplotlib.pyplot as plt
+            figure = plt.figure(figsize=(12, 6))
+        else:
+            from matplotlib.figure import Figure
+            figure = Figure(figsize=(12, 6))
+        figure.add_subplot()
+        return figure
+
+    @staticmethod
+    def draw_returns(axes, cumulative_strategy_returns, benchmark_returns=None,
+                     title='Cumulative Returns of Long, Short, and Long-Short Portfolios vs Benchmark'):
+        for column, (label, color) in LINES.items():
+            Plotter.draw_line(axes, cumulative_strategy_returns[column], label=label, color=color)
+        if benchmark_returns is not None and not benchmark_returns.empty:
+            # Plot S&P 500 cumulative returns
+            Plotter.draw_line(axes, benchmark_returns, label='S&P 500', color='orange', linestyle='--')
+
+        axes.set_title(title)
+        axes.set_xlabel('Date')
+        axes.set_ylabel('Cumulative Return')
+        axes.legend(loc='upper left')
+        axes.grid(True)
+
+    @staticmethod
+    def draw_line(axes, series, **style):
+        series = series.dropna().astype('float64')
+        kept = Plotter.downsample(series.index.to_numpy(dtype='datetime64[ns]').astype('int64'), series.to_numpy())
+        axes.plot(series.index[kept], series.to_numpy()[kept], **style)
+
+    @staticmethod
+    def save(figure, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        figure.savefig(path, dpi=100)
+        return path
+
+    @staticmethod
+    def downsample(x, y, max_points=MAX_POINTS):
+        """Positions of the points Largest-Triangle-Three-Buckets keeps to draw the line through (x, y) with at
+        most max_points points. The first and last points are kept, and from each bucket in between the point
+        spanning the largest triangle with the point kept before it and the average of the next bucket, which
+        keeps peaks and drawdowns that evenly spaced sampling would miss."""
+        x, y = np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64')
+        points = len(x)
+        if points <= max_points or max_points < 3:
+            return np.arange(points)
+
+        edges = np.linspace(1, points - 1, max_points - 1).astype('int64')
+        # Average of each bucket, the bucket after the last one being the last point
+        counts = np.diff(np.r_[edges, points])
+        average_x, average_y = np.add.reduceat(x, edges) / counts, np.add.reduceat(y, edges) / counts
+        # Buckets are a few points each, plain floats beat a NumPy call per bucket
+        xs, ys, starts = x.tolist(), y.tolist(), edges.tolist() + [points]
+        kept = np.empty(max_points, dtype='int64')
+        kept[0], kept[-1] = 0, points - 1
+        previous = 0
+        for bucket in range(max_points - 2):
+            previous_x, previous_y = xs[previous], ys[previous]
+            next_x, next_y = average_x[bucket + 1] - previous_x, average_y[bucket + 1] - previous_y
+            largest_area = -1.0
+            for point in range(starts[bucket], starts[bucket + 1]):
+                area = abs(next_x * (ys[point] - previous_y) - (xs[point] - previous_x) * next_y)
+                if area > largest_area:
+                    largest_area, previous = area, point
+            kept[bucket + 1] = previous
+        return kept
+
+    @staticmethod
+    def benchmark_returns(start_date, end_date, ticker=BENCHMARK_TICKER, cache_directory=BENCHMARK_CACHE_DIRECTORY,
+                          max_age=BENCHMARK_MAX_AGE):
+        """Cumulative returns of ticker from start_date to end_date, None if they can't be had."""
+        closes = Plotter.benchmark_closes(start_date, end_date, ticker, cache_directory, max_age)
+        if closes is None:
+            return None
+        closes = closes[(closes.index >= pd.Timestamp(start_date)) & (closes.index <= pd.Timestamp(end_date))]
+        return (1 + closes.pct_change()).cumprod()
+
+    @staticmethod
+    def benchmark_closes(start_date, end_date, ticker=BENCHMARK_TICKER, cache_directory=BENCHMARK_CACHE_DIRECTORY,
+                         max_age=BENCHMARK_MAX_AGE):
+        """Daily closes of ticker, read from <cache_directory>/<ticker>.parquet. The cache is downloaded again
+        only when it doesn't cover the dates and is older than max_age. Offline, a stale cache is still used."""
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        path = os.path.join(cache_directory, f"{ticker.lstrip('^')}.parquet")
+        cached = pd.read_parquet(path)['close'] if os.path.exists(path) else None
+        # A week of slack for the weekends and holidays at either end of the window
+        covered = (cached is not None and not cached.empty and cached.index.min() <= start_date + pd.Timedelta(days=7)
+                   and cached.index.max() >= end_date - pd.Timedelta(days=7))
+        age = pd.Timedelta(seconds=time.time() - os.path.getmtime(path)) if cached is not None else None
+        if covered or (cached is not None and age < max_age):
+            return cached
+
+        download_start = min(start_date, cached.index.min()) if cached is not None and not cached.empty else start_date
+        try:
+            closes = Plotter.download_closes(ticker, download_start, max(end_date, pd.Timestamp.now().normalize()))
+        except Exception as error:
+            print(f"Couldn't download {ticker} ({error}), using the cached series")
+            return cached
+        if closes.empty:
+            return cached
+        os.makedirs(cache_directory, exist_ok=True)
+        closes.to_frame('close').to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        return closes
+
+    @staticmethod
+    def download_closes(ticker, start_date, end_date):
+        import yfinance as yf
+        print(f"Downloading {ticker} closes")
+        data = yf.download(ticker, start=start_date, end=end_date + pd.Timedelta(days=1), progress=False)
+        closes = data['Close']
+        # Recent yfinance versions return a column per ticker
+        if isinstance(closes, pd.DataFrame):
+            closes = closes.iloc[:, 0]
+        closes.index = pd.DatetimeIndex(closes.index).tz_localize(None)
+        return closes.rename('close').dropna()
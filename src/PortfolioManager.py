@@ -1,57 +1,67 @@
 import pandas as pd
 
+from src.FactorEngine import FactorEngine
+from src.Instrumentation import Instrumentation
+from src.ScoreBook import ScoreBook
+
 
 class PortfolioManager:
-    def __init__(self, inactivity_threshold, long_portfolio_size, short_portfolio_size):
+    def __init__(self, inactivity_threshold, long_portfolio_size, short_portfolio_size, track_eligibility=False,
+                 ranking='Score'):
         self.inactivity_threshold = inactivity_threshold
         self.long_portfolio_size = long_portfolio_size
         self.short_portfolio_size = short_portfolio_size
-        self.long_portfolio = {}  # {cusip: {'score': Score, 'entry_date': date, 'last_traded_date': date}}
+        # With track_eligibility, holdings also go inactive after too long below the market cap threshold
+        self.track_eligibility = track_eligibility
+        # {security_id: {'score': Score, 'entry_date': date, 'last_traded_date': date, 'last_eligible_date': date}}
+        # 'last_eligible_date' is None unless eligibility is tracked
+        self.long_portfolio = {}
         self.short_portfolio = {}
-        self.company_scores = pd.DataFrame(columns=['cusip', 'score', 'datadate'])
-        self.company_scores.set_index('cusip', inplace=True)
+        # Funda column companies are ranked on, the Piotroski score, another factor or a composite of factors
+        self.ranking = ranking
+        self.company_scores = ScoreBook(levels=FactorEngine.levels(ranking))
 
     def purge_inactive_from_company_scores(self, current_date):
         """Purge companies from company_scores if they haven't published reports for over a year."""
         # Calculate the date exactly one year before the current date
         yearly_inactivity_cutoff = current_date - pd.DateOffset(years=1)
 
-        # Identify companies in company_scores that haven't published a report for over a year
-        inactive_companies = self.company_scores[self.company_scores['datadate'] < yearly_inactivity_cutoff].index
-        self.company_scores.drop(inactive_companies, inplace=True)
+        # Drop companies in company_scores that haven't published a report for over a year
+        self.company_scores.purge_older_than(yearly_inactivity_cutoff)
 
     def remove_inactive_holdings(self, portfolio, current_date):
-        """Remove inactive holdings from a given portfolio and company_scores."""
-        to_remove = []
-        for cusip, info in portfolio.items():
-            days_inactive = (current_date - info['last_traded_date']).days
+        """Remove inactive holdings from a given portfolio and company_scores: those that haven't traded, or have
+        been below the market cap threshold, for more than inactivity_threshold days. Returns the removed
+        holdings, each with the 'exit_date' it went inactive on."""
+        removed = {}
+        for security_id, info in portfolio.items():
+            last_active_date = info['last_traded_date']
+            if info['last_eligible_date'] is not None:
+                last_active_date = min(last_active_date, info['last_eligible_date'])
+            days_inactive = (current_date - last_active_date).days
             if days_inactive > self.inactivity_threshold:
-                to_remove.append(cusip)
-        for cusip in to_remove:
-            del portfolio[cusip]
-            if cusip in self.company_scores.index:
-                self.company_scores.drop(cusip, inplace=True)
-
+                # The first inactive day, which is current_date unless the indexed engine is catching up on
+                # days without events
+                removed[security_id] = {**info, 'exit_date': last_active_date + pd.Timedelta(
+                    days=self.inactivity_threshold + 1)}
+        for security_id in removed:
+            del portfolio[security_id]
+            self.company_scores.remove(security_id)
+        return removed
+
+    @Instrumentation.stage()
     def update_company_scores(self, new_reports, current_date):
         self.purge_inactive_from_company_scores(current_date)
-        for idx, row in new_reports.iterrows():
-            cusip = row['cusip']
-            score = row['Score']
-            # Check if the cusip already exists in company_scores
-            if cusip in self.company_scores.index:
-                # Update only if the new datadate is more recent than the existing one
-                if current_date > self.company_scores.loc[cusip, 'datadate']:
-                    self.company_scores.loc[cusip] = {'score': score, 'datadate': current_date}
-            else:
-                # Add new entry if the cusip does not exist
-                self.company_scores.loc[cusip] = {'score': score, 'datadate': current_date}
+        # Adds new companies and updates existing ones whose stored datadate is older than current_date
+        self.company_scores.update(new_reports['security_id'].to_numpy(), new_reports[self.ranking].to_numpy(),
+                                   current_date)
 
+    @Instrumentation.stage()
     def build_portfolios(self, current_date, long_portfolio_size, short_portfolio_size):
-        if not self.company_scores.empty:
-            # Get the top companies by score
-            sorted_scores = self.company_scores.sort_values(by=['score', 'datadate'], ascending=[False, True])
-            top_companies = sorted_scores.head(long_portfolio_size)
-            bottom_companies = sorted_scores.tail(short_portfolio_size)
+        if len(self.company_scores):
+            # Get the top and bottom companies by score, ties going to the earliest datadate
+            top_companies = self.company_scores.top(long_portfolio_size)
+            bottom_companies = self.company_scores.bottom(short_portfolio_size)
 
             self.long_portfolio = self._update_portfolio(self.long_portfolio, top_companies, current_date)
             self.short_portfolio = self._update_portfolio(self.short_portfolio, bottom_companies, current_date)
@@ -60,42 +70,60 @@ class PortfolioManager:
             self.short_portfolio = {}
 
     def _update_portfolio(self, existing_portfolio, companies, current_date):
-        """Create a new portfolio based on the given companies, retaining last_traded_date for existing entries."""
+        """Create a new portfolio from (security_id, score) pairs, retaining last_traded_date for existing entries."""
         new_portfolio = {}
 
-        for cusip in companies.index:
-            score = companies.loc[cusip, 'score']
-
-            # Retain the last_traded_date if the company is already in the existing portfolio
-            if cusip in existing_portfolio:
-                last_traded_date = existing_portfolio[cusip]['last_traded_date']
+        for security_id, score in companies:
+            # Retain the last_traded_date and last_eligible_date if the company is already in the existing portfolio
+            if security_id in existing_portfolio:
+                last_traded_date = existing_portfolio[security_id]['last_traded_date']
+                last_eligible_date = existing_portfolio[security_id]['last_eligible_date']
             else:
-                # Initialize last_traded_date to current_date if it's a new entry
+                # Initialize them to current_date if it's a new entry
                 last_traded_date = current_date
+                last_eligible_date = current_date if self.track_eligibility else None
 
-            new_portfolio[cusip] = {
+            new_portfolio[security_id] = {
                 'score': score,
                 'entry_date': current_date,
-                'last_traded_date': last_traded_date
+                'last_traded_date': last_traded_date,
+                'last_eligible_date': last_eligible_date,
             }
         return new_portfolio
 
 
+    @Instrumentation.stage()
     def remove_inactive_holdings_from_portfolios(self, current_date):
-        """Remove inactive holdings from both long and short portfolios and company scores."""
-        self.remove_inactive_holdings(self.long_portfolio, current_date)
-        self.remove_inactive_holdings(self.short_portfolio, current_date)
-
-    def update_last_traded_date(self, traded_cusips, current_date):
-        for cusip in self.long_portfolio.keys():
-            if cusip in traded_cusips:
-                self.long_portfolio[cusip]['last_traded_date'] = current_date
-
-        for cusip in self.short_portfolio.keys():
-            if cusip in traded_cusips:
-                self.short_portfolio[cusip]['last_traded_date'] = current_date
+        """Remove inactive holdings from both long and short portfolios and company scores. Returns the removed
+        holdings of each side, {'long': {security_id: info}, 'short': {...}}."""
+        return {'long': self.remove_inactive_holdings(self.long_portfolio, current_date),
+                'short': self.remove_inactive_holdings(self.short_portfolio, current_date)}
+
+    @Instrumentation.stage()
+    def update_last_traded_date(self, traded_security_ids, current_date):
+        for security_id in self.long_portfolio.keys():
+            if security_id in traded_security_ids:
+                self.long_portfolio[security_id]['last_traded_date'] = current_date
+
+        for security_id in self.short_portfolio.keys():
+            if security_id in traded_security_ids:
+                self.short_portfolio[security_id]['last_traded_date'] = current_date
+
+    @Instrumentation.stage()
+    def update_last_eligible_date(self, eligible_security_ids, current_date):
+        """Mark held companies whose market cap met the threshold on current_date."""
+        for portfolio in (self.long_portfolio, self.short_portfolio):
+            for security_id in eligible_security_ids:
+                if security_id in portfolio:
+                    portfolio[security_id]['last_eligible_date'] = current_date
+
+    def remap_security_ids(self, id_map):
+        """Move holdings and company scores to new security ids, id_map[old id]."""
+        self.long_portfolio = {int(id_map[security_id]): info for security_id, info in self.long_portfolio.items()}
+        self.short_portfolio = {int(id_map[security_id]): info for security_id, info in self.short_portfolio.items()}
+        self.company_scores.remap(id_map)
 
     def get_current_portfolios(self):
-        long_cusips = list(self.long_portfolio.keys())
-        short_cusips = list(self.short_portfolio.keys())
-        return long_cusips, short_cusips
+        long_security_ids = list(self.long_portfolio.keys())
+        short_security_ids = list(self.short_portfolio.keys())
+        return long_security_ids, short_security_ids
@@ -0,0 +1,262 @@
+import numpy as np
+import pandas as pd
+
+from src.DataStore import DATE_COLUMNS
+from src.Instrumentation import Instrumentation
+
+COMPARISONS = {'>=': np.greater_equal, '<=': np.less_equal, '>': np.greater, '<': np.less, '==': np.equal,
+               '!=': np.not_equal}
+NOT_NULL = 'not_null'
+
+
+class Filter:
+    """Keep the rows where column <operator> value, or where column isn't null for the 'not_null' operator."""
+
+    def __init__(self, column, operator, value=None):
+        if operator not in COMPARISONS and operator != NOT_NULL:
+            raise ValueError(f"Unknown filter operator {operator!r}")
+        self.column, self.operator, self.value = column, operator, value
+
+    def columns(self):
+        return [self.column]
+
+    def passes(self, other):
+        # Filters commute with each other
+        return True
+
+    def __repr__(self):
+        return f"Filter({self.column} {self.operator}{'' if self.operator == NOT_NULL else ' ' + repr(self.value)})"
+
+
+class DropFirst:
+    """Drop the row with the lowest order value in each group, ordering the rows by (group, order). Rows
+    without a group are dropped."""
+
+    def __init__(self, group, order):
+        self.group, self.order = group, order
+
+    def columns(self):
+        return [self.group, self.order]
+
+    def passes(self, other):
+        # Whole groups are kept or dropped by a filter on the group, and an upper bound on the order only drops
+        # rows after each group's first. Any other filter could remove a first row, so must run after this
+        return other.column == self.group or (other.column == self.order and other.operator in ('<=', '<'))
+
+    def __repr__(self):
+        return f"DropFirst({self.group} by {self.order})"
+
+
+class DropDuplicates:
+    """Keep the first of the rows with the same values in subset."""
+
+    def __init__(self, subset):
+        self.subset = list(subset)
+
+    def columns(self):
+        return self.subset
+
+    def passes(self, other):
+        # A filter on the subset keeps or drops every copy of a row alike
+        return other.column in self.subset
+
+    def __repr__(self):
+        return f"DropDuplicates({', '.join(self.subset)})"
+
+
+class QueryPlan:
+    """A lazy chain of row operations over a DataFrame or a DataStore table, run in one pass by collect().
+
+    Before running, filters are moved as early as the operations allow, and those reaching the source are
+    applied while it is read: for a store table they are pushed into the Parquet read, skipping partitions and
+    row groups. Only the columns the operations and the output need are read. Operations work on arrays of row
+    positions, and each output column is materialized once, at the end."""
+
+    def __init__(self, frame=None, store=None, table_name=None, dictionary_columns=None):
+        self.frame = frame
+        self.store, self.table_name, self.dictionary_columns = store, table_name, dictionary_columns
+        self.operations = []
+        self.date_columns = []
+        self.output_columns = None
+
+    @classmethod
+    def scan_frame(cls, frame):
+        return cls(frame=frame)
+
+    @classmethod
+    def scan_store(cls, store, table_name, columns=None, dictionary_columns=None):
+        return cls(store=store, table_name=table_name, dictionary_columns=dictionary_columns).select(columns)
+
+    def chain(self, **changes):
+        plan = QueryPlan(self.frame, self.store, self.table_name, self.dictionary_columns)
+        plan.operations, plan.date_columns = self.operations, self.date_columns
+        plan.output_columns = self.output_columns
+        for name, value in changes.items():
+            setattr(plan, name, value)
+        return plan
+
+    def then(self, operation):
+        return self.chain(operations=self.operations + [operation])
+
+    def parse_dates(self, column):
+        """Read column as datetimes, invalid dates becoming NaT."""
+        return self.chain(date_columns=self.date_columns + [column])
+
+    def filter(self, column, operator, value=None):
+        return self.then(Filter(column, operator, value))
+
+    def filter_range(self, column, start=None, end=None):
+        plan = self if start is None else self.filter(column, '>=', pd.Timestamp(start))
+        return plan if end is None else plan.filter(column, '<=', pd.Timestamp(end))
+
+    def drop_nulls(self, columns):
+        plan = self
+        for column in columns:
+            plan = plan.filter(column, NOT_NULL)
+        return plan
+
+    def drop_first(self, group, order):
+        return self.then(DropFirst(group, order))
+
+    def drop_duplicates(self, subset):
+        return self.then(DropDuplicates(subset))
+
+    def select(self, columns):
+        return self.chain(output_columns=None if columns is None else list(columns))
+
+    def optimize(self):
+        """The scan filters and the remaining operations, after moving every filter as early as it can go."""
+        operations = []
+        for operation in self.operations:
+            operations.append(operation)
+            if not isinstance(operation, Filter):
+                continue
+            position = len(operations) - 1
+            while position > 0 and operations[position - 1].passes(operation):
+                operations[position - 1], operations[position] = operations[position], operations[position - 1]
+                position -= 1
+        scan_filters = []
+        while operations and isinstance(operations[0], Filter):
+            scan_filters.append(operations.pop(0))
+        return scan_filters, operations
+
+    def explain(self):
+        scan_filters, operations = self.optimize()
+        source = f"Scan({self.table_name or 'frame'}, columns={self.scan_columns(scan_filters, operations)}, " \
+                 f"filters={scan_filters})"
+        return '\n'.join([source] + [f"  {operation}" for operation in operations])
+
+    def scan_columns(self, scan_filters, operations):
+        """Columns the plan reads, None for all of them."""
+        if self.output_columns is None:
+            return None
+        # Filters applied by the store read need not be loaded
+        used = [] if self.store is not None else [column for filter_ in scan_filters for column in filter_.columns()]
+        used += [column for operation in operations for column in operation.columns()]
+        return list(dict.fromkeys(self.output_columns + used))
+
+    @Instrumentation.stage()
+    def collect(self):
+        """Run the plan, returning a DataFrame with a fresh index."""
+        scan_filters, operations = self.optimize()
+        columns = self.scan_columns(scan_filters, operations)
+        if self.store is not None:
+            # The scan filters run inside the Parquet read, so are recorded together
+            with Instrumentation.measure(f"Scan({self.table_name}, filters={scan_filters})") as measurement:
+                frame = self.read_store(scan_filters, columns)
+                measurement['rows_out'] = len(frame)
+            scan_filters = []
+        else:
+            frame = self.frame
+        output_columns = list(frame.columns) if self.output_columns is None else self.output_columns
+
+        parsed = {}
+
+        def values(column):
+            if column in self.date_columns:
+                if column not in parsed:
+                    parsed[column] = pd.to_datetime(frame[column], errors='coerce').to_numpy()
+                return parsed[column]
+            return frame[column].to_numpy()
+
+        positions = None
+        if scan_filters:
+            mask = np.ones(len(frame), dtype=bool)
+            for filter_ in scan_filters:
+                # Recorded one by one like the other operations, with the rows still passing before and after
+                with Instrumentation.measure(repr(filter_), int(np.count_nonzero(mask))) as measurement:
+                    mask &= QueryPlan.evaluate(filter_, values(filter_.column))
+                    measurement['rows_out'] = int(np.count_nonzero(mask))
+            positions = None if mask.all() else np.flatnonzero(mask)
+        for operation in operations:
+            if positions is None:
+                positions = np.arange(len(frame))
+            positions = QueryPlan.apply(operation, positions, values)
+
+        if positions is None:
+            # Every row, in order: the source's columns are shared rather than copied
+            result = frame.copy(deep=False) if self.output_columns is None else frame[output_columns]
+            for column in self.date_columns:
+                if column in result.columns:
+                    result[column] = values(column)
+            result.index = pd.RangeIndex(len(result))
+            return result
+        return pd.DataFrame({column: values(column)[positions] if column in self.date_columns
+                             else frame[column].array.take(positions) for column in output_columns})
+
+    def read_store(self, scan_filters, columns):
+        """Read the table, with the scan filters on its date column as the date window, and the rest as
+        Parquet filters."""
+        date_column = DATE_COLUMNS[self.table_name]
+        start_date = end_date = None
+        filters, not_null = [], []
+        for filter_ in scan_filters:
+            if filter_.operator == NOT_NULL:
+                not_null.append(filter_.column)
+            elif filter_.column == date_column and filter_.operator == '>=':
+                start_date = max(start_date, filter_.value) if start_date is not None else filter_.value
+            elif filter_.column == date_column and filter_.operator == '<=':
+                end_date = min(end_date, filter_.value) if end_date is not None else filter_.value
+            else:
+                filters.append((filter_.column, '=' if filter_.operator == '==' else filter_.operator, filter_.value))
+        return self.store.read(self.table_name, columns=columns, start_date=start_date, end_date=end_date,
+                               filters=filters, not_null=not_null, dictionary_columns=self.dictionary_columns)
+
+    @staticmethod
+    def evaluate(filter_, values):
+        """Mask of the values passing filter_. Comparisons with a null are false, as in Parquet."""
+        if filter_.operator == NOT_NULL:
+            return ~pd.isna(values)
+        value = filter_.value
+        if values.dtype.kind == 'M':
+            value = np.datetime64(pd.Timestamp(value), 'ns')
+        with np.errstate(invalid='ignore'):
+            return COMPARISONS[filter_.operator](values, value)
+
+    @staticmethod
+    def apply(operation, positions, values):
+        """The positions of the rows left after operation, in the order it leaves them. Each operation is
+        recorded as its own stage, so the rows every filter removes show up in the instrumentation report."""
+        with Instrumentation.measure(repr(operation), len(positions)) as measurement:
+            positions = QueryPlan.run_operation(operation, positions, values)
+            measurement['rows_out'] = len(positions)
+        return positions
+
+    @staticmethod
+    def run_operation(operation, positions, values):
+        if isinstance(operation, Filter):
+            return positions[QueryPlan.evaluate(operation, values(operation.column)[positions])]
+        if isinstance(operation, DropFirst):
+            groups, _ = pd.factorize(values(operation.group)[positions], sort=True)
+            grouped = groups >= 0
+            positions, groups = positions[grouped], groups[grouped]
+            # Stable, so rows tied on (group, order) keep their order, and NaT orders last within a group
+            order = np.lexsort((values(operation.order)[positions], groups))
+            positions, groups = positions[order], groups[order]
+            first = np.ones(len(groups), dtype=bool)
+            first[1:] = groups[1:] != groups[:-1]
+            return positions[~first]
+        if isinstance(operation, DropDuplicates):
+            keys = pd.DataFrame({column: values(column)[positions] for column in operation.subset})
+            return positions[~keys.duplicated(keep='first').to_numpy()]
+        raise TypeError(f"Unknown operation {operation!r}")
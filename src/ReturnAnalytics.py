@@ -0,0 +1,233 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.HoldingsLog import SIDES, HoldingsLog
+from src.Instrumentation import Instrumentation
+from src.WorkerData import WorkerData, shared_data
+
+TRADING_DAYS_PER_YEAR = 252
+RESAMPLES = 10_000
+# Resamples per task sent to a worker process, also the batch each matrix operation works on
+CHUNK_SIZE = 500
+BLOCK_LENGTH = 20  # Trading days per bootstrap block, keeps about a month of autocorrelation in each resample
+# Statistics whose bootstrap p-value tests them being no greater than zero, a null that means no edge
+TESTED_STATISTICS = ['annual_return', 'sharpe', 'alpha']
+
+
+class ReturnAnalytics:
+    """Significance of the long-short returns: block bootstrap confidence intervals of the annual return,
+    Sharpe ratio and alpha, and a placebo test against random portfolios of the same sizes.
+
+    Each chunk of resamples is one set of NumPy matrix operations over a (resamples x days) matrix, and chunks
+    run across a process pool. Every chunk has its own seed derived from seed, so results don't depend on the
+    number of workers."""
+
+    @staticmethod
+    def long_short_returns(daily_strategy_returns, trading_dates):
+        """Daily long-short returns, as fractions, on the trading dates of a processed run."""
+        long_short = daily_strategy_returns['long_short'].reindex(pd.DatetimeIndex(trading_dates))
+        return long_short.astype('float64').fillna(1) - 1
+
+    @staticmethod
+    def market_returns(crsp_index):
+        """Equal weighted return of every security traded each day, a benchmark that needs no outside data."""
+        returns = np.asarray(crsp_index.returns, dtype='float64')
+        valid = ~np.isnan(returns)
+        sums = np.add.reduceat(np.where(valid, returns, 0), crsp_index.day_starts)
+        counts = np.add.reduceat(valid.astype('int64'), crsp_index.day_starts)
+        return pd.Series(np.where(counts > 0, sums / np.maximum(counts, 1), 0),
+                         index=pd.DatetimeIndex(crsp_index.dates))
+
+    @staticmethod
+    @Instrumentation.stage()
+    def bootstrap(long_short, market=None, resamples=RESAMPLES, block_length=BLOCK_LENGTH, confidence=0.95,
+                  workers=None, seed=0):
+        """Circular block bootstrap of the daily long-short returns. Returns one row per statistic with its
+        observed value, confidence interval and, for TESTED_STATISTICS, the one-sided p-value of it being no
+        greater than zero.
+        Alpha and beta are against market, e.g. market_returns(crsp_index), and left out without it."""
+        returns = long_short.to_numpy(dtype='float64')
+        market = market.reindex(long_short.index).fillna(0).to_numpy(dtype='float64') if market is not None else None
+        observed = ReturnAnalytics.statistics(returns[None, :], None if market is None else market[None, :])
+        chunks = ReturnAnalytics.run_chunks(ReturnAnalytics.bootstrap_chunk,
+                                            {'returns': returns, 'market': market, 'block_length': block_length},
+                                            resamples, workers, seed)
+        resampled = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in observed}
+
+        tail = (1 - confidence) / 2
+        rows = {}
+        for name, values in resampled.items():
+            observed_value = observed[name][0]
+            p_value = np.nan
+            if name in TESTED_STATISTICS:
+                # Shifted bootstrap p-value: how often a resample lands as far again above the observed value
+                exceedances = np.count_nonzero(values - observed_value >= observed_value)
+                p_value = (exceedances + 1) / (len(values) + 1)
+            rows[name] = {'observed': observed_value, 'lower': np.nanquantile(values, tail),
+                          'upper': np.nanquantile(values, 1 - tail), 'p_value': p_value}
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+    @staticmethod
+    def bootstrap_chunk(size, rng):
+        returns, market = shared_data['returns'], shared_data['market']
+        days, block_length = len(returns), min(shared_data['block_length'], len(returns))
+        blocks = -(-days // block_length)
+        starts = rng.integers(0, days, size=(size, blocks))
+        # Each resample strings together blocks wrapping around the end of the sample
+        rows = ((starts[:, :, None] + np.arange(block_length)) % days).reshape(size, -1)[:, :days]
+        return ReturnAnalytics.statistics(returns[rows], None if market is None else market[rows])
+
+    @staticmethod
+    def statistics(returns, market=None):
+        """Annualized statistics of each row of a (resamples x days) matrix of daily returns."""
+        mean = returns.mean(axis=1)
+        volatility = returns.std(axis=1, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistics = {
+                'annual_return': mean * TRADING_DAYS_PER_YEAR,
+                'annual_volatility': volatility * np.sqrt(TRADING_DAYS_PER_YEAR),
+                'sharpe': np.where(volatility > 0, mean / volatility, np.nan) * np.sqrt(TRADING_DAYS_PER_YEAR),
+            }
+            if market is not None:
+                market_mean = market.mean(axis=1)
+                covariance = ((returns - mean[:, None]) * (market - market_mean[:, None])).mean(axis=1)
+                beta = covariance / market.var(axis=1)
+                statistics['alpha'] = (mean - beta * market_mean) * TRADING_DAYS_PER_YEAR
+                statistics['beta'] = beta
+        return statistics
+
+    @staticmethod
+    @Instrumentation.stage()
+    def placebo(long_short, holdings, funda, crsp_index, portfolio_update_delay, resamples=RESAMPLES,
+                workers=None, seed=0):
+        """Compare the strategy with random portfolios. At each rebalance in holdings, e.g.
+        StrategyRunner.holdings(), every placebo draws long and short portfolios of the strategy's sizes at
+        random from the companies eligible then: those with a report in funda in the year up to the lagged date,
+        the companies the score book holds. Placebos hold their draws until the next rebalance.
+
+        Returns the observed Sharpe ratio and cumulative return over the same days, where they fall in the
+        placebo distribution, and the p-value of a random portfolio doing at least as well."""
+        # Portfolio sizes as built, rebalances that left both portfolios empty having none
+        rebalances = HoldingsLog.entries(holdings).groupby('rebalance_date')['side'].value_counts()
+        rebalances = rebalances.unstack(fill_value=0).reindex(index=np.sort(holdings['rebalance_date'].unique()),
+                                                              columns=SIDES, fill_value=0)
+        dates = pd.DatetimeIndex(crsp_index.dates)
+        days = dates[(dates >= rebalances.index.min()) & (dates <= long_short.index.max())]
+        returns = long_short.reindex(days).fillna(0).to_numpy(dtype='float64')
+
+        periods, universe = ReturnAnalytics.placebo_periods(rebalances, days, funda, portfolio_update_delay)
+        returns_matrix = ReturnAnalytics.returns_matrix(crsp_index, days, universe)
+        chunks = ReturnAnalytics.run_chunks(ReturnAnalytics.placebo_chunk,
+                                            {'returns_matrix': returns_matrix, 'periods': periods},
+                                            resamples, workers, seed)
+        observed = {'sharpe': ReturnAnalytics.statistics(returns[None, :])['sharpe'][0],
+                    'cumulative_return': np.prod(1 + returns)}
+
+        rows = {}
+        for name, observed_value in observed.items():
+            values = np.concatenate([chunk[name] for chunk in chunks])
+            rows[name] = {'observed': observed_value, 'placebo_mean': np.nanmean(values),
+                          'percentile': np.mean(values < observed_value),
+                          'p_value': (np.count_nonzero(values >= observed_value) + 1) / (len(values) + 1)}
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+    @staticmethod
+    def placebo_periods(rebalances, days, funda, portfolio_update_delay):
+        """(first day, end day, eligible columns, long size, short size) of each rebalance with trading days,
+        and the security ids the columns stand for."""
+        funda = funda[['security_id', 'datadate']].dropna()
+        funda = funda[funda['security_id'] >= 0].sort_values('datadate', kind='mergesort')
+        report_dates = funda['datadate'].to_numpy(dtype='datetime64[ns]')
+        security_ids = funda['security_id'].to_numpy(dtype='int64')
+
+        eligible = []
+        for rebalance_date in rebalances.index:
+            # Same one year window purge_inactive_from_company_scores keeps in the score book
+            lagged_date = rebalance_date - pd.Timedelta(days=portfolio_update_delay)
+            cutoff_date = lagged_date - pd.DateOffset(years=1)
+            first = np.searchsorted(report_dates, np.datetime64(cutoff_date, 'ns'), side='left')
+            last = np.searchsorted(report_dates, np.datetime64(lagged_date, 'ns'), side='right')
+            eligible.append(np.unique(security_ids[first:last]))
+        universe = np.unique(np.concatenate(eligible)) if eligible else np.array([], dtype='int64')
+
+        # Each rebalance's portfolios are held from its first trading day up to the next rebalance
+        bounds = np.r_[np.searchsorted(days.to_numpy(dtype='datetime64[ns]'),
+                                       rebalances.index.to_numpy(dtype='datetime64[ns]')), len(days)]
+        periods = []
+        for position, (long_size, short_size) in enumerate(rebalances[['long', 'short']].to_numpy()):
+            start, end = bounds[position], bounds[position + 1]
+            if end > start:
+                periods.append((start, end, np.searchsorted(universe, eligible[position]), long_size, short_size))
+        return periods, universe
+
+    @staticmethod
+    def returns_matrix(crsp_index, days, universe):
+        """(universe x days) float32 matrix of daily returns, NaN where a security has no return that day. A
+        security's returns are contiguous, so gathering a portfolio's holdings copies whole rows."""
+        matrix = np.full((len(universe), len(days)), np.nan, dtype='float32')
+        if not len(days) or not len(universe):
+            return matrix
+        first, last = crsp_index.day_positions[days[0]], crsp_index.day_positions[days[-1]]
+        rows = slice(crsp_index.day_starts[first], crsp_index.day_ends[last])
+        row_days = np.repeat(np.arange(last - first + 1),
+                             crsp_index.day_ends[first:last + 1] - crsp_index.day_starts[first:last + 1])
+        security_ids = np.asarray(crsp_index.security_ids[rows], dtype='int64')
+        columns = np.clip(np.searchsorted(universe, security_ids), 0, len(universe) - 1)
+        held = universe[columns] == security_ids
+        matrix[columns[held], row_days[held]] = crsp_index.returns[rows][held]
+        return matrix
+
+    @staticmethod
+    def placebo_chunk(size, rng):
+        matrix = shared_data['returns_matrix']
+        daily_returns = np.zeros((size, matrix.shape[1]))
+        for start, end, eligible, long_size, short_size in shared_data['periods']:
+            period_returns = matrix[eligible, start:end]
+            valid = ~np.isnan(period_returns)
+            period_returns = np.where(valid, period_returns, 0)
+            daily_returns[:, start:end] = (
+                ReturnAnalytics.random_portfolio_returns(period_returns, valid, long_size, size, rng)
+                - ReturnAnalytics.random_portfolio_returns(period_returns, valid, short_size, size, rng))
+        return {'sharpe': ReturnAnalytics.statistics(daily_returns)['sharpe'],
+                'cumulative_return': np.prod(1 + daily_returns, axis=1)}
+
+    @staticmethod
+    def random_portfolio_returns(period_returns, valid, portfolio_size, size, rng):
+        """(size x days) average returns of size random portfolios of portfolio_size of the eligible companies,
+        the rows of period_returns, whose missing returns are zeros flagged by valid. Like the strategy, a day's
+        average skips missing returns and is zero when no holding has one."""
+        eligible = len(period_returns)
+        portfolio_size = min(portfolio_size, eligible)
+        if portfolio_size == 0:
+            return np.zeros((size, period_returns.shape[1]))
+        # Partial Fisher-Yates shuffle of every row at once, portfolio_size swaps rather than a full shuffle
+        draws = np.tile(np.arange(eligible, dtype='int32'), (size, 1))
+        rows = np.arange(size)
+        for position in range(portfolio_size):
+            swaps = rng.integers(position, eligible, size)
+            draws[rows, position], draws[rows, swaps] = draws[rows, swaps], draws[rows, position]
+        draws = draws[:, :portfolio_size]
+        sums = period_returns[draws].sum(axis=1, dtype='float64')  # size x portfolio_size x days, summed over holdings
+        counts = valid[draws].sum(axis=1)
+        return np.where(counts > 0, sums / np.maximum(counts, 1), 0)
+
+    @staticmethod
+    def run_chunks(chunk_function, data, resamples, workers=None, seed=0):
+        """Run chunk_function(size, rng) over chunks of CHUNK_SIZE resamples, in a process pool that receives
+        data once per worker, or in this process with workers=1."""
+        sizes = [min(CHUNK_SIZE, resamples - start) for start in range(0, resamples, CHUNK_SIZE)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        if workers == 1:
+            WorkerData.load_shared_data(data)
+            return [chunk_function(size, np.random.default_rng(chunk_seed)) for size, chunk_seed in zip(sizes, seeds)]
+        workers = min(workers or os.cpu_count() or 1, len(sizes))
+        with ProcessPoolExecutor(max_workers=workers, initializer=WorkerData.load_shared_data,
+                                 initargs=(data,)) as executor:
+            return list(executor.map(ReturnAnalytics.run_chunk, [chunk_function] * len(sizes), sizes, seeds))
+
+    @staticmethod
+    def run_chunk(chunk_function, size, seed):
+        return chunk_function(size, np.random.default_rng(seed))
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+SCORE_LEVELS = 10  # Piotroski scores run from 0 to 9
+
+
+class ScoreBook:
+    """Latest score of each company, held in flat arrays indexed by its SecurityMaster security id.
+
+    For discrete scores taking levels integer values, per-score bucket counts tell top() and bottom() which
+    score levels they need, so only the companies in those levels are ranked instead of the whole book.
+    With levels=None scores are continuous, e.g. a composite factor, and the whole book is ranked."""
+
+    def __init__(self, capacity=1024, levels=SCORE_LEVELS):
+        self.levels = levels
+        self.score_dtype = 'int8' if levels is not None else 'float64'
+        self.scores = np.zeros(capacity, dtype=self.score_dtype)
+        self.datadates = np.zeros(capacity, dtype='datetime64[ns]')
+        self.sequence = np.zeros(capacity, dtype='int64')  # Order companies entered the book, the last tiebreak
+        self.active = np.zeros(capacity, dtype=bool)
+        self.bucket_counts = np.zeros(levels or 0, dtype='int64')
+        self.count = 0
+        self.next_sequence = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, security_id):
+        return 0 <= security_id < len(self.active) and bool(self.active[security_id])
+
+    def reserve(self, max_security_id):
+        """Grow the arrays, doubling their size, until max_security_id fits."""
+        capacity = len(self.active)
+        while capacity <= max_security_id:
+            capacity *= 2
+        extra = capacity - len(self.active)
+        if extra:
+            self.scores = np.concatenate([self.scores, np.zeros(extra, dtype=self.score_dtype)])
+            self.datadates = np.concatenate([self.datadates, np.zeros(extra, dtype='datetime64[ns]')])
+            self.sequence = np.concatenate([self.sequence, np.zeros(extra, dtype='int64')])
+            self.active = np.concatenate([self.active, np.zeros(extra, dtype=bool)])
+
+    def update(self, security_ids, scores, datadate):
+        """Add each company, or replace its entry if datadate is more recent than the stored one.
+        When a security appears more than once in the batch its first row is used, rows without a score are
+        skipped."""
+        if len(security_ids) == 0:
+            return
+        ids = np.asarray(security_ids, dtype='int64')
+        scores = np.asarray(scores, dtype='float64')
+        scored = ~np.isnan(scores)
+        ids, scores = ids[scored], scores[scored].astype(self.score_dtype)
+        if len(ids) == 0:
+            return
+        self.reserve(ids.max())
+        _, first_rows = np.unique(ids, return_index=True)
+        first_rows.sort()
+        ids, scores = ids[first_rows], scores[first_rows]
+        datadate = np.datetime64(pd.Timestamp(datadate), 'ns')
+
+        existing = self.active[ids]
+        changed = ~existing | (self.datadates[ids] < datadate)
+        if self.levels is not None:
+            np.subtract.at(self.bucket_counts, self.scores[ids[existing & changed]], 1)
+            np.add.at(self.bucket_counts, scores[changed], 1)
+        self.scores[ids[changed]] = scores[changed]
+        self.datadates[ids[changed]] = datadate
+
+        new_ids = ids[~existing]
+        self.sequence[new_ids] = self.next_sequence + np.arange(len(new_ids))
+        self.next_sequence += len(new_ids)
+        self.active[new_ids] = True
+        self.count += len(new_ids)
+
+    def remap(self, id_map):
+        """Move every company to a new security id, id_map[old id], e.g. after the SecurityMaster was rebuilt
+        with more CUSIPs. Scores, datadates and book order are kept."""
+        ids = np.flatnonzero(self.active)
+        new_ids = np.asarray(id_map, dtype='int64')[ids]
+        scores, datadates, sequence = self.scores[ids], self.datadates[ids], self.sequence[ids]
+        self.active[:] = False
+        self.reserve(new_ids.max() if len(new_ids) else 0)
+        self.scores[new_ids], self.datadates[new_ids], self.sequence[new_ids] = scores, datadates, sequence
+        self.active[new_ids] = True
+
+    def remove(self, security_id):
+        if security_id in self:
+            self.active[security_id] = False
+            self.count -= 1
+            if self.levels is not None:
+                self.bucket_counts[self.scores[security_id]] -= 1
+
+    def purge_older_than(self, cutoff_date):
+        """Drop every company whose latest report is dated before cutoff_date."""
+        stale = np.flatnonzero(self.active & (self.datadates < np.datetime64(pd.Timestamp(cutoff_date), 'ns')))
+        self.active[stale] = False
+        self.count -= len(stale)
+        if self.levels is not None:
+            self.bucket_counts -= np.bincount(self.scores[stale], minlength=self.levels)
+
+    def top(self, n):
+        """The n best companies as (security_id, score) pairs, by score desc, datadate asc, then book order."""
+        return self.select(n, range(len(self.bucket_counts) - 1, -1, -1), lambda level: self.scores >= level)[:n]
+
+    def bottom(self, n):
+        """The n worst companies, in the order they have at the end of the same ranking."""
+        if n <= 0:
+            return []
+        return self.select(n, range(len(self.bucket_counts)), lambda level: self.scores <= level)[-n:]
+
+    def select(self, n, levels, within_level):
+        # Walk the score levels from the wanted end until they hold n companies; only those get ranked
+        candidates = self.active.copy()
+        covered = 0
+        for level in levels:
+            covered += self.bucket_counts[level]
+            if covered >= n:
+                candidates &= within_level(level)
+                break
+        ids = np.flatnonzero(candidates)
+        ids = ids[np.lexsort((self.sequence[ids], self.datadates[ids], -self.scores[ids].astype('float64')))]
+        return [(int(security_id), self.scores[security_id]) for security_id in ids]
+
+    def to_frame(self):
+        """The book as a DataFrame indexed by security id, in the order companies entered it."""
+        ids = np.flatnonzero(self.active)
+        ids = ids[np.argsort(self.sequence[ids], kind='stable')]
+        return pd.DataFrame({'score': self.scores[ids], 'datadate': self.datadates[ids]},
+                            index=pd.Index(ids.astype('int32'), name='security_id'))
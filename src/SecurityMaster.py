@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+
+class SecurityMaster:
+    """Dense int32 security ids for 8 character CUSIPs. Frames are encoded once when they are loaded, the
+    pipeline works on ids from then on, and ids are decoded back to CUSIPs only for output."""
+
+    def __init__(self, cusips):
+        # Sorted, so ordering by security id is the same as ordering by CUSIP
+        self.cusips = pd.Index(np.unique(np.asarray(cusips, dtype=str)), name='cusip')
+
+    @classmethod
+    def from_columns(cls, *cusip_columns):
+        """Build the master from the distinct values of one or more raw CUSIP columns."""
+        return cls(np.concatenate([SecurityMaster.standardize(SecurityMaster.distinct(column))
+                                   for column in cusip_columns]))
+
+    def __len__(self):
+        return len(self.cusips)
+
+    def encode(self, df, cusip_column='cusip'):
+        """Replace df's CUSIP column, in place, with a security_id column. Missing CUSIPs get id -1.
+        Only the distinct CUSIPs are standardized, so a categorical column is encoded without touching strings."""
+        cusips = df[cusip_column]
+        if not isinstance(cusips.dtype, pd.CategoricalDtype):
+            cusips = cusips.astype('category')
+        category_ids = self.cusips.get_indexer(self.standardize(cusips.cat.categories))
+        codes = cusips.cat.codes.to_numpy()
+        df['security_id'] = np.where(codes >= 0, category_ids[codes], -1).astype('int32')
+        del df[cusip_column]
+        return df
+
+    def decode(self, security_ids):
+        """CUSIPs of the given security ids."""
+        return self.cusips[np.asarray(security_ids)].to_numpy()
+
+    @staticmethod
+    def distinct(cusip_column):
+        if isinstance(cusip_column.dtype, pd.CategoricalDtype):
+            return cusip_column.cat.categories
+        return pd.Index(cusip_column.dropna().unique())
+
+    @staticmethod
+    def standardize(cusips):
+        """Trim CUSIP codes and keep their first 8 characters, the issuer and issue code shared by CRSP and
+        Compustat."""
+        # TODO: Check matching with cusip codes longer than 8 digits.
+        return pd.Index(cusips).astype(str).str.strip().str[:8]
@@ -1,81 +1,233 @@
+import os
+import pickle
+
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from src.DataHandler import DataHandler
+from src.CrspIndex import CrspIndex
+from src.HoldingsLog import HoldingsLog
+from src.Instrumentation import Instrumentation
 from src.PortfolioManager import PortfolioManager
 
+# Event dates the indexed engine processes between checkpoints
+CHECKPOINT_EVERY = 250
+
 
 class StrategyRunner:
-    def __init__(self, funda, crsp, inactivity_threshold, long_portfolio_size, short_portfolio_size, start_date, end_date, portfolio_update_delay):
+    def __init__(self, funda, crsp, inactivity_threshold, long_portfolio_size, short_portfolio_size, start_date, end_date, portfolio_update_delay,
+                 crsp_index=None, market_cap_index=None, market_cap_threshold=None, ranking='Score', holdings_path=None,
+                 security_master=None):
+        # crsp may be None when a prebuilt crsp_index is given, which only the indexed engine needs
+        # With a market_cap_index, holdings below market_cap_threshold for more than inactivity_threshold days are
+        # dropped, as are holdings that stop trading
+        # ranking is the funda column portfolios are built on, the Piotroski 'Score' or another factor column
+        # With a holdings_path, the holdings log is streamed to that Parquet file during the run, otherwise it is
+        # kept in memory. The security_master funda and crsp were encoded with decodes it to CUSIPs
         self.funda = funda
         self.crsp = crsp
+        self.crsp_index = crsp_index
+        self.market_cap_index = market_cap_index
+        self.market_cap_threshold = market_cap_threshold
         self.inactivity_threshold = inactivity_threshold
         self.portfolio_update_delay = portfolio_update_delay
         self.long_portfolio_size = long_portfolio_size
         self.short_portfolio_size = short_portfolio_size
-        self.portfolio_manager = PortfolioManager(inactivity_threshold, long_portfolio_size, short_portfolio_size)
+        self.portfolio_manager = PortfolioManager(inactivity_threshold, long_portfolio_size, short_portfolio_size,
+                                                  track_eligibility=market_cap_index is not None, ranking=ranking)
 
         self.all_dates = pd.date_range(start=start_date, end=end_date, freq='D')
-        self.trading_dates = crsp['date'].sort_values().unique()
-        self.rebalancing_dates = funda['datadate'].sort_values().unique()
+        self.trading_dates = crsp['date'].sort_values().unique() if crsp is not None else crsp_index.dates
         # Initialize DataFrame to store cumulative returns
         self.daily_strategy_returns = pd.DataFrame(index=self.trading_dates,
                                                    columns=['long', 'short', 'long_short'])
         self.cumulative_strategy_returns = pd.DataFrame(index=self.trading_dates,
                                                         columns=['long', 'short', 'long_short'])
-        # Initialize DataFrame to store long and short cusips at each rebalancing date
-        self.portfolio_tickers = pd.DataFrame(columns=['long_tickers', 'short_tickers'], index=self.rebalancing_dates)
         #TODO: Move to data
-        # Create a dictionary mapping cusip to tic (ticker)
-        self.cusip_to_tic = funda[['cusip', 'tic']].drop_duplicates().set_index('cusip')['tic']
+        # Create a dictionary mapping security_id to tic (ticker), used to decode portfolios for output
+        self.security_id_to_tic = funda[['security_id', 'tic']].drop_duplicates().set_index('security_id')['tic']
+        # Long and short holdings at each rebalancing date
+        self.security_master = security_master
+        self.holdings_log = HoldingsLog(holdings_path, self.security_id_to_tic, security_master)
+
+    def run_strategy(self, engine='indexed', show_progress=True, checkpoint_path=None,
+                     checkpoint_every=CHECKPOINT_EVERY, resume=False):
+        """Run the backtest. The 'indexed' engine visits only rebalancing and trading dates and gives the same
+        results as the 'daily' engine, which rescans funda and crsp for every calendar day.
+
+        With a checkpoint_path, the indexed engine saves its state there every checkpoint_every event dates and
+        at the end of the run. resume continues from that state with the same results as an uninterrupted run,
+        which also extends a finished backtest to a later end_date. funda and crsp must be the ones the checkpoint
+        was taken with, up to its date. When they were encoded with a security_master holding other CUSIPs, e.g.
+        new listings in an extended window, the checkpoint's security ids are moved to the new ones."""
+        if engine == 'indexed':
+            self.run_strategy_indexed(show_progress, checkpoint_path, checkpoint_every, resume)
+        elif checkpoint_path is not None:
+            raise ValueError("Checkpoints are only supported by the 'indexed' engine")
+        elif engine == 'daily':
+            self.run_strategy_daily(show_progress)
+        else:
+            raise ValueError(f"Unknown engine '{engine}', expected 'indexed' or 'daily'")
+        self.holdings_log.close()
 
-    def run_strategy(self):
-        for current_date in tqdm(self.all_dates, desc="Processing Trading Dates"):
+    @Instrumentation.stage()
+    def run_strategy_daily(self, show_progress=True):
+        for current_date in tqdm(self.all_dates, desc="Processing Trading Dates", disable=not show_progress):
             # Check if any new reports were released on this date
             lagged_date = current_date - pd.Timedelta(days=self.portfolio_update_delay)
             new_reports = self.funda[self.funda['datadate'] == lagged_date]
 
             if not new_reports.empty:
-                # Update company_scores with new reports as of the lagged date
-                self.portfolio_manager.update_company_scores(new_reports, lagged_date)
+                self.rebalance(new_reports, lagged_date, current_date)
+
+            # Remove inactive holdings from portfolios
+            self.remove_inactive_holdings(current_date)
+
+            # Calculate daily returns for current portfolios
+            self.calculate_daily_returns(current_date)
 
-                # Build the portfolios as of the lagged date
-                self.portfolio_manager.build_portfolios(current_date, self.long_portfolio_size,
-                                                        self.short_portfolio_size)
+    @Instrumentation.stage()
+    def run_strategy_indexed(self, show_progress=True, checkpoint_path=None, checkpoint_every=CHECKPOINT_EVERY,
+                             resume=False):
+        reports_by_date = self.index_funda_by_date()
+        if self.crsp_index is None:
+            self.crsp_index = CrspIndex.from_crsp(self.crsp)
+        if len(self.all_dates) == 0:
+            return
+        start_date, end_date = self.all_dates[0], self.all_dates[-1]
+        update_delay = pd.Timedelta(days=self.portfolio_update_delay)
+        rebalancing_dates = {report_date + update_delay for report_date in reports_by_date
+                             if start_date <= report_date + update_delay <= end_date}
+        trading_dates = {date for date in self.crsp_index.day_positions if start_date <= date <= end_date}
 
-                # Get current portfolios (long and short cusips)
-                long_cusips, short_cusips = self.portfolio_manager.get_current_portfolios()
+        daily_returns = {}
+        event_dates = sorted(rebalancing_dates | trading_dates)
+        if resume:
+            daily_returns, checkpoint_date = self.load_checkpoint(checkpoint_path)
+            if checkpoint_date > end_date:
+                raise ValueError(f"Checkpoint of {checkpoint_date:%Y-%m-%d} is past the end date {end_date:%Y-%m-%d}")
+            event_dates = [date for date in event_dates if date > checkpoint_date]
 
-                # Map cusips to tickers using the cusip_to_tic dictionary
-                long_tickers = self.cusip_to_tic.loc[long_cusips].dropna().tolist()
-                short_tickers = self.cusip_to_tic.loc[short_cusips].dropna().tolist()
+        for event_number, current_date in enumerate(tqdm(event_dates, desc="Processing Event Dates",
+                                                         disable=not show_progress), start=1):
+            if current_date > start_date:
+                # Holdings can go inactive on days without events, catch up on the days skipped since the last one
+                self.remove_inactive_holdings(current_date - pd.Timedelta(days=1))
 
-                # Store the portfolios for the current rebalancing date
-                self.portfolio_tickers.loc[lagged_date] = [long_tickers, short_tickers]
+            if current_date in rebalancing_dates:
+                lagged_date = current_date - update_delay
+                self.rebalance(reports_by_date[lagged_date], lagged_date, current_date)
 
-            # Remove inactive holdings from portfolios
-            self.portfolio_manager.remove_inactive_holdings_from_portfolios(current_date)
+            self.remove_inactive_holdings(current_date)
 
-            # Calculate daily returns for current portfolios
-            self.calculate_daily_returns(current_date)
+            if current_date in trading_dates:
+                daily_returns[current_date] = self.calculate_indexed_daily_returns(current_date,
+                                                                                   *self.crsp_index.day(current_date))
+            if checkpoint_path is not None and event_number % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path, daily_returns, current_date)
+        self.remove_inactive_holdings(end_date)
+        if checkpoint_path is not None:
+            self.holdings_log.close()
+            self.save_checkpoint(checkpoint_path, daily_returns, end_date)
+        self.store_indexed_daily_returns(daily_returns, trading_dates)
+
+    def checkpoint_parameters(self):
+        """Settings a checkpoint is only valid for."""
+        return {'start_date': self.all_dates[0], 'inactivity_threshold': self.inactivity_threshold,
+                'long_portfolio_size': self.long_portfolio_size, 'short_portfolio_size': self.short_portfolio_size,
+                'portfolio_update_delay': self.portfolio_update_delay, 'ranking': self.portfolio_manager.ranking,
+                'market_cap_threshold': self.market_cap_threshold if self.market_cap_index is not None else None}
+
+    @Instrumentation.stage()
+    def save_checkpoint(self, path, daily_returns, checkpoint_date):
+        """Snapshot everything the indexed engine has built up to and including checkpoint_date."""
+        state = {
+            'parameters': self.checkpoint_parameters(),
+            'checkpoint_date': checkpoint_date,
+            'daily_returns': daily_returns,
+            'portfolio_manager': self.portfolio_manager,
+            'holdings_log': self.holdings_log.checkpoint(),
+            # The CUSIP of each security id, which only the security master the run was encoded with can tell
+            'cusips': self.security_master.cusips.to_numpy(dtype=object) if self.security_master is not None else None,
+        }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump(state, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
 
+    def load_checkpoint(self, path):
+        """Restore the state saved by save_checkpoint. Returns the daily returns so far and the checkpoint date."""
+        with open(path, 'rb') as checkpoint_file:
+            state = pickle.load(checkpoint_file)
+        if state['parameters'] != self.checkpoint_parameters():
+            raise ValueError(f"Checkpoint {path} was taken with different parameters: {state['parameters']}")
+        id_map = self.security_id_map(path, state['cusips'])
+        print(f"Resuming from checkpoint of {state['checkpoint_date']:%Y-%m-%d}")
+        self.portfolio_manager = state['portfolio_manager']
+        if id_map is not None:
+            self.portfolio_manager.remap_security_ids(id_map)
+        self.holdings_log.restore(state['holdings_log'], id_map)
+        return state['daily_returns'], state['checkpoint_date']
+
+    def security_id_map(self, path, cusips):
+        """This run's security id of each security id in a checkpoint taken with the given CUSIPs, None when the
+        ids are the same."""
+        if cusips is None and self.security_master is None:
+            return None
+        if cusips is None or self.security_master is None:
+            raise ValueError(f"Checkpoint {path} was taken {'without' if cusips is None else 'with'} a security "
+                             f"master, resume it {'without' if cusips is None else 'with'} one too")
+        id_map = self.security_master.cusips.get_indexer(cusips)
+        if (id_map < 0).any():
+            raise ValueError(f"{np.count_nonzero(id_map < 0)} CUSIPs of checkpoint {path} are missing from the "
+                             f"security master")
+        return None if np.array_equal(id_map, np.arange(len(cusips))) else id_map
+
+    @Instrumentation.stage()
+    def rebalance(self, new_reports, lagged_date, current_date):
+        # Update company_scores with new reports as of the lagged date
+        self.portfolio_manager.update_company_scores(new_reports, lagged_date)
+
+        # Build the portfolios as of the lagged date
+        self.portfolio_manager.build_portfolios(current_date, self.long_portfolio_size,
+                                                self.short_portfolio_size)
+
+        # Log the portfolios in effect from the current date
+        self.holdings_log.record_rebalance(current_date, self.portfolio_manager.long_portfolio,
+                                           self.portfolio_manager.short_portfolio)
+
+    def remove_inactive_holdings(self, current_date):
+        """Drop the holdings gone inactive by current_date from the portfolios, logging their exits."""
+        for side, holdings in self.portfolio_manager.remove_inactive_holdings_from_portfolios(current_date).items():
+            self.holdings_log.record_exits(side, holdings)
+
+    @Instrumentation.stage()
+    def index_funda_by_date(self):
+        """Group the reports by filing date once, keeping their original order within each date."""
+        funda = self.funda[self.funda['datadate'].notna()].sort_values('datadate', kind='mergesort')
+        return {pd.Timestamp(date): reports for date, reports in funda.groupby('datadate', sort=False)}
+
+    @Instrumentation.stage()
     def calculate_daily_returns(self, current_date):
         crsp_today = self.crsp[self.crsp['date'] == current_date]
 
         # Get current portfolios
-        long_cusips, short_cusips = self.portfolio_manager.get_current_portfolios()
+        long_ids, short_ids = self.portfolio_manager.get_current_portfolios()
 
-        # Long positions
-        long_returns = crsp_today[crsp_today['cusip'].isin(long_cusips)]['ret']
+        # Long positions, averaged in float64 although crsp stores returns as float32
+        long_returns = crsp_today[crsp_today['security_id'].isin(long_ids)]['ret'].astype('float64')
         avg_long_return = long_returns.mean() if not long_returns.empty else 0
 
         # Short positions
-        short_returns = crsp_today[crsp_today['cusip'].isin(short_cusips)]['ret']
+        short_returns = crsp_today[crsp_today['security_id'].isin(short_ids)]['ret'].astype('float64')
         avg_short_return = short_returns.mean() if not short_returns.empty else 0
 
         # Update last traded date for companies that traded today
-        traded_cusips = crsp_today['cusip'].unique()
-        self.portfolio_manager.update_last_traded_date(traded_cusips, current_date)
+        traded_ids = crsp_today['security_id'].unique()
+        self.portfolio_manager.update_last_traded_date(traded_ids, current_date)
+        # Eligibility is checked on trading days only, like the indexed engine does
+        if not crsp_today.empty:
+            self.update_eligibility(long_ids + short_ids, current_date)
 
         # Calculate net portfolio return (difference between long and short returns)
         avg_long_short_return = avg_long_return - avg_short_return
@@ -85,6 +237,55 @@ class StrategyRunner:
         self.daily_strategy_returns.loc[current_date, 'short'] = avg_short_return + 1
         self.daily_strategy_returns.loc[current_date, 'long_short'] = avg_long_short_return + 1
 
+    @Instrumentation.stage()
+    def calculate_indexed_daily_returns(self, current_date, security_ids, returns):
+        """calculate_daily_returns over one date's rows of the crsp index. Returns (long, short) averages."""
+        long_ids, short_ids = self.portfolio_manager.get_current_portfolios()
+        avg_long_return = self.average_return(security_ids, returns, long_ids)
+        avg_short_return = self.average_return(security_ids, returns, short_ids)
+
+        # Update last traded date for held companies that traded today
+        held_ids = long_ids + short_ids
+        traded = np.isin(held_ids, security_ids)
+        traded_ids = [security_id for security_id, was_traded in zip(held_ids, traded) if was_traded]
+        self.portfolio_manager.update_last_traded_date(traded_ids, current_date)
+        self.update_eligibility(held_ids, current_date)
+        return avg_long_return, avg_short_return
+
+    def update_eligibility(self, held_ids, current_date):
+        """Mark the holdings whose latest market cap on or before current_date meets the threshold."""
+        if self.market_cap_index is None or not held_ids:
+            return
+        eligible = self.market_cap_index.as_of(held_ids, current_date) >= self.market_cap_threshold
+        self.portfolio_manager.update_last_eligible_date(
+            [security_id for security_id, is_eligible in zip(held_ids, eligible) if is_eligible], current_date)
+
+    @staticmethod
+    def average_return(security_ids, returns, held_ids):
+        held_returns = returns[np.isin(security_ids, held_ids)].astype('float64')
+        if not len(held_returns):
+            return 0
+        # Same arithmetic as Series.mean: NaNs summed as zero with numpy's pairwise sum, divided by the valid count
+        valid = ~np.isnan(held_returns)
+        return np.where(valid, held_returns, 0).sum() / np.float64(valid.sum()) if valid.any() else np.nan
+
+    @Instrumentation.stage()
+    def store_indexed_daily_returns(self, daily_returns, trading_dates):
+        """Fill daily_strategy_returns exactly as the daily engine leaves it, including the rows its
+        .loc assignments append for calendar days without crsp data."""
+        rows = self.daily_strategy_returns.index.get_indexer(list(daily_returns))
+        values = np.empty((len(rows), 3), dtype=object)
+        for row, (avg_long_return, avg_short_return) in enumerate(daily_returns.values()):
+            values[row] = [avg_long_return + 1, avg_short_return + 1, avg_long_return - avg_short_return + 1]
+        self.daily_strategy_returns.iloc[rows] = values
+
+        non_trading_dates = [date for date in self.all_dates if date not in trading_dates]
+        if non_trading_dates:
+            appended = pd.DataFrame(1, index=pd.DatetimeIndex(non_trading_dates),
+                                    columns=self.daily_strategy_returns.columns, dtype=object)
+            self.daily_strategy_returns = pd.concat([self.daily_strategy_returns, appended])
+
+    @Instrumentation.stage()
     def process_returns(self):
         # Fill any missing values with 1
         self.daily_strategy_returns = self.daily_strategy_returns.fillna(1)
@@ -96,6 +297,11 @@ class StrategyRunner:
 
         return self.cumulative_strategy_returns
 
-    def save_portfolios_to_csv(self, directory='../output_data', file_name='long_short_portfolios.csv'):
-        """Save the long and short portfolios (tickers) with rebalancing dates."""
-        DataHandler.save_file_to_directory(self.portfolio_tickers, directory, file_name)
\ No newline at end of file
+    def holdings(self, start_date=None, end_date=None):
+        """The logged holdings of the rebalances from start_date to end_date, one row per holding and one per
+        exit, see HoldingsLog."""
+        return self.holdings_log.read(start_date, end_date)
+
+    def portfolio_at(self, date):
+        """The long and short holdings in effect on date."""
+        return self.holdings_log.portfolio_at(date)
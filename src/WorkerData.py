@@ -0,0 +1,12 @@
+# Data a worker process receives once in its pool initializer and reuses for every task it runs
+shared_data = {}
+
+
+class WorkerData:
+    """Per-process state of the process pools run by ReturnAnalytics and ParameterSweep."""
+
+    @staticmethod
+    def load_shared_data(data):
+        """Pool initializer, replaces the worker's shared_data with data."""
+        shared_data.clear()
+        shared_data.update(data)
@@ -3,28 +3,60 @@ import pandas as pd
 from DataHandler import DataHandler
 from Plotter import Plotter
 from StrategyRunner import StrategyRunner
+from src.FactorEngine import FactorEngine
+from src.Instrumentation import Instrumentation
+from src.ReturnAnalytics import ReturnAnalytics
 
 if __name__ == "__main__":
     START_DATE = '2019-01-01'
     END_DATE = '2024-11-01'
     LONG_PORTFOLIO_SIZE = 20  # Maximum number of positions in long portfolio
     SHORT_PORTFOLIO_SIZE = 10  # Maximum number of positions in short portfolio
-    INACTIVITY_THRESHOLD = 30  # Number of consecutive days below market cap threshold
+    INACTIVITY_THRESHOLD = 30  # Number of consecutive days below market cap threshold, or without trading
     MARKET_CAP_THRESHOLD = 2_000_000_000  # Minimum market cap in dollars
     PORTFOLIO_UPDATE_DELAY = 60  # Number of days before the data in a report is used to update portfolios
     GET_NEW_DATA = False
+    INCREMENTAL_REFRESH = True  # Only fetch data newer than what is already stored when getting new data
+    SQL_FEATURES = False  # Compute factor lags and market caps in the database when getting new data
+    DOWNLOAD_CONNECTIONS = 1  # Parallel WRDS connections for a full download
+    INSTRUMENT = False  # Record per-stage timings, memory and row counts to ../output_data/run_report.json
+    PROFILE_STAGES = []  # Stages to also profile with cProfile when instrumenting, e.g. ['DataHandler.clean_funda']
+    RANKING = 'Score'  # Factor column to rank companies on, e.g. 'Score', 'altman_z', or 'composite'
+    COMPOSITE_WEIGHTS = {'Score': 1.0, 'altman_z': 0.5}  # Factor weights of the 'composite' ranking
+    HOLDINGS_FILE = '../output_data/holdings.parquet'  # Long and short holdings at every rebalance, streamed
+    CHECKPOINT_FILE = '../output_data/checkpoint.pkl'  # Backtest state saved periodically and at the end of the run
+    RESUME = False  # Continue from CHECKPOINT_FILE, after an interruption or to extend a finished run to END_DATE
+    SIGNIFICANCE_TESTS = False  # Bootstrap confidence intervals and a random portfolio placebo test of the returns
+    PLOT_FILE = None  # Render the returns plot to a file, e.g. '../output_data/returns.png', instead of showing it
 
-    funda, crsp = DataHandler.fetch_or_read_data(GET_NEW_DATA, START_DATE, END_DATE)
+    if INSTRUMENT:
+        Instrumentation.enable(PROFILE_STAGES)
 
-    funda = DataHandler.clean_funda(funda, START_DATE, END_DATE, MARKET_CAP_THRESHOLD, crsp)
+    funda, crsp, security_master = DataHandler.fetch_or_read_data(GET_NEW_DATA, START_DATE, END_DATE, incremental=INCREMENTAL_REFRESH,
+                                                                  sql_features=SQL_FEATURES,
+                                                                  download_connections=DOWNLOAD_CONNECTIONS)
 
-    crsp = DataHandler.clean_crsp(crsp, START_DATE, END_DATE)
+    market_cap_index = DataHandler.build_market_cap_index(crsp)
+    funda = DataHandler.clean_funda(funda, START_DATE, END_DATE, MARKET_CAP_THRESHOLD, crsp, market_cap_index)
+    if RANKING == 'composite':
+        funda['composite'] = FactorEngine.composite(funda, COMPOSITE_WEIGHTS)
 
-    strategy_runner = StrategyRunner(funda, crsp, INACTIVITY_THRESHOLD, LONG_PORTFOLIO_SIZE, SHORT_PORTFOLIO_SIZE, START_DATE, END_DATE, PORTFOLIO_UPDATE_DELAY)
-    strategy_runner.run_strategy()
-    strategy_runner.save_portfolios_to_csv()
+    crsp = DataHandler.clean_crsp(crsp)
+
+    strategy_runner = StrategyRunner(funda, crsp, INACTIVITY_THRESHOLD, LONG_PORTFOLIO_SIZE, SHORT_PORTFOLIO_SIZE, START_DATE, END_DATE, PORTFOLIO_UPDATE_DELAY,
+                                     market_cap_index=market_cap_index, market_cap_threshold=MARKET_CAP_THRESHOLD,
+                                     ranking=RANKING, holdings_path=HOLDINGS_FILE, security_master=security_master)
+    strategy_runner.run_strategy(checkpoint_path=CHECKPOINT_FILE, resume=RESUME)
     cumulative_strategy_returns = strategy_runner.process_returns()
+    if SIGNIFICANCE_TESTS:
+        long_short = ReturnAnalytics.long_short_returns(strategy_runner.daily_strategy_returns,
+                                                        strategy_runner.crsp_index.dates)
+        print(ReturnAnalytics.bootstrap(long_short, ReturnAnalytics.market_returns(strategy_runner.crsp_index)))
+        print(ReturnAnalytics.placebo(long_short, strategy_runner.holdings(), funda, strategy_runner.crsp_index,
+                                      PORTFOLIO_UPDATE_DELAY))
+    if INSTRUMENT:
+        Instrumentation.write_report('../output_data/run_report.json')
 
     plot_start_date = funda['datadate'].min() + pd.Timedelta(days=PORTFOLIO_UPDATE_DELAY)
-    Plotter.plot_strategy_returns(cumulative_strategy_returns, plot_start_date)
+    Plotter.plot_strategy_returns(cumulative_strategy_returns, plot_start_date, output_path=PLOT_FILE)
     print("done")
\ No newline at end of file
@@ -0,0 +1,44 @@
+import argparse
+import os
+
+from src.DataHandler import DataHandler
+from src.ParameterSweep import ParameterSweep
+from src.Plotter import Plotter
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the strategy over a grid of parameters.")
+    parser.add_argument('--start-date', default='2019-01-01')
+    parser.add_argument('--end-date', default='2024-11-01')
+    parser.add_argument('--long-portfolio-size', type=int, nargs='+', default=[20])
+    parser.add_argument('--short-portfolio-size', type=int, nargs='+', default=[10])
+    parser.add_argument('--inactivity-threshold', type=int, nargs='+', default=[30])
+    parser.add_argument('--market-cap-threshold', type=float, nargs='+', default=[2_000_000_000])
+    parser.add_argument('--portfolio-update-delay', type=int, nargs='+', default=[60])
+    parser.add_argument('--ranking', nargs='+', default=['Score'],
+                        help="Factor columns to rank on, e.g. Score altman_z composite")
+    parser.add_argument('--composite-weights', nargs='+', default=['Score=1.0', 'altman_z=0.5'],
+                        metavar='FACTOR=WEIGHT', help="Factor weights of the composite ranking")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes, defaults to one per core")
+    parser.add_argument('--output-directory', default='../output_data')
+    parser.add_argument('--plot-directory', help="Also render each combination's returns to a PNG file here")
+    args = parser.parse_args()
+    composite_weights = {factor: float(weight) for factor, weight in
+                         (factor_weight.split('=', 1) for factor_weight in args.composite_weights)}
+
+    funda, crsp, _ = DataHandler.fetch_or_read_data(False, args.start_date, args.end_date)
+    parameter_sweep = ParameterSweep(funda, crsp, args.start_date, args.end_date,
+                                     composite_weights=composite_weights if 'composite' in args.ranking else None)
+    combinations = ParameterSweep.grid(long_portfolio_size=args.long_portfolio_size,
+                                       short_portfolio_size=args.short_portfolio_size,
+                                       inactivity_threshold=args.inactivity_threshold,
+                                       market_cap_threshold=args.market_cap_threshold,
+                                       portfolio_update_delay=args.portfolio_update_delay,
+                                       ranking=args.ranking)
+    summary, returns = parameter_sweep.run(combinations, args.workers)
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    summary.to_csv(os.path.join(args.output_directory, 'sweep_summary.csv'))
+    returns.to_parquet(os.path.join(args.output_directory, 'sweep_returns.parquet'))
+    print(summary.to_string())
+    if args.plot_directory:
+        Plotter.plot_sweep_returns(returns, args.plot_directory)
@@ -0,0 +1,29 @@
+import sqlite3
+
+import pandas as pd
+
+
+class LocalSQLConnection:
+    """Stand-in for wrds.Connection over a local database, for running the download code without WRDS."""
+
+    def __init__(self, connection):
+        # Anything pandas.read_sql_query accepts: a sqlite3 connection or a SQLAlchemy engine (e.g. Postgres)
+        self.connection = connection
+
+    @classmethod
+    def sqlite(cls, libraries):
+        """Open SQLite database files as WRDS libraries, e.g. {'crsp': 'crsp.db', 'comp': 'comp.db'},
+        so that queries against crsp.dsf and comp.funda run unchanged."""
+        # A WRDSConnectionPool hands connections between threads, one query at a time
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        for library, database_path in libraries.items():
+            connection.execute(f"ATTACH DATABASE '{database_path}' AS {library}")
+        return cls(connection)
+
+    def raw_sql(self, sql):
+        return pd.read_sql_query(sql, self.connection)
+
+    def close(self):
+        # SQLAlchemy engines are disposed rather than closed
+        close = getattr(self.connection, 'close', None) or self.connection.dispose
+        close()
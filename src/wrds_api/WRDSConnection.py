@@ -1,5 +1,8 @@
+import pandas as pd
 import wrds
 
+from src.FactorEngine import FactorEngine
+
 
 # Fetch Piotroski F-scores and stock prices
 # Assume Compustat data for Piotroski scores and CRSP data for stock prices
@@ -9,12 +12,40 @@ import wrds
 #comp.funda name of compustat database
 
 class WRDSConnection:
-    def __init__(self, username, password):
-        self.db = wrds.Connection(wrds_username=username, wrds_password=password)
+    def __init__(self, username, password, db=None):
+        # db can be any object with raw_sql() and close(), e.g. a LocalSQLConnection standing in for WRDS
+        self.db = db if db is not None else wrds.Connection(wrds_username=username, wrds_password=password)
 
     def download_fundamental_data(self, start_date, end_date):
         print('Fetching fundamental data')
-        funda_query = f"""
+        return self.db.raw_sql(self.funda_query(start_date, end_date))
+
+    def download_factor_inputs(self, start_date, end_date, lag_start_date=None):
+        """Download only what the pipeline needs from comp.funda, with the factors' lagged inputs and the market
+        cap on each datadate computed by the database, see factor_inputs_query."""
+        print('Fetching factor inputs')
+        return self.db.raw_sql(self.factor_inputs_query(start_date, end_date, lag_start_date))
+
+    def download_crsp_data(self, start_date, end_date):
+        print('Fetching crsp data')
+        return self.db.raw_sql(self.crsp_query(start_date, end_date))
+
+    def stream_crsp_data(self, store, start_date, end_date):
+        """Download CRSP one month at a time straight into the store, resuming an interrupted download."""
+        print('Streaming crsp data')
+        chunk_queries = self.crsp_chunk_queries(start_date, end_date)
+        remaining_keys = store.begin_chunked_write('crsp', list(chunk_queries))
+        for chunk_key in remaining_keys:
+            print(f'Fetching crsp data {chunk_key.replace("_", " to ")}')
+            store.write_chunk('crsp', chunk_key, self.db.raw_sql(chunk_queries[chunk_key]))
+        store.finish_chunked_write('crsp')
+
+    def raw_sql(self, sql):
+        return self.db.raw_sql(sql)
+
+    @staticmethod
+    def funda_query(start_date, end_date):
+        return f"""
             SELECT gvkey, datadate, fyear, fic, tic,
                    at, lt, pstkl, txditc, pstkrv, aco, lco, csho,
                    txdb, pstk, ni, oancf, dltt, mkvalt, ebit,
@@ -27,16 +58,70 @@ class WRDSConnection:
             AND consol = 'C'
             AND datadate BETWEEN '{start_date}' AND '{end_date}'
         """
-        return self.db.raw_sql(funda_query)
 
-    def download_crsp_data(self, start_date, end_date):
-        print('Fetching crsp data')
-        crsp_query = f"""
+    @staticmethod
+    def factor_inputs_query(start_date, end_date, lag_start_date=None):
+        """Filings from start_date to end_date with the registered factors' inputs and lags. Lags reach back to filings
+        from lag_start_date (all of them if None), the market cap is the latest crsp.dsf price and shares
+        outstanding on or before datadate. That's one lookup per filing, which needs crsp.dsf indexed on
+        (cusip, date) to be fast."""
+        lag_start_condition = f"AND datadate >= '{lag_start_date}'" if lag_start_date is not None else ''
+        inputs = ', '.join(FactorEngine.inputs())
+        lags = ',\n                       '.join(
+            f'LAG({column}, {lag}) OVER cusip_history AS {FactorEngine.lag_column(column, lag)}'
+            for column, lag in FactorEngine.lags())
+        return f"""
+            WITH filings AS (
+                SELECT gvkey, cusip, tic, datadate, {inputs}
+                FROM comp.funda
+                WHERE indfmt = 'INDL'
+                AND datafmt = 'STD'
+                AND popsrc = 'D'
+                AND consol = 'C'
+                AND cusip IS NOT NULL
+                AND datadate <= '{end_date}'
+                {lag_start_condition}
+            ),
+            lagged AS (
+                SELECT filings.*,
+                       {lags}
+                FROM filings
+                WINDOW cusip_history AS (PARTITION BY cusip ORDER BY datadate, gvkey)
+            )
+            SELECT cusip, tic, datadate, {inputs},
+                   {', '.join(FactorEngine.lag_column(column, lag) for column, lag in FactorEngine.lags())},
+                   (SELECT dsf.prc * dsf.shrout * 1000
+                    FROM crsp.dsf AS dsf
+                    WHERE dsf.cusip = SUBSTR(lagged.cusip, 1, 8)
+                    AND dsf.date BETWEEN '{start_date}' AND lagged.datadate
+                    ORDER BY dsf.date DESC
+                    LIMIT 1) AS market_cap
+            FROM lagged
+            WHERE datadate >= '{start_date}'
+            ORDER BY cusip, datadate, gvkey
+        """
+
+    @staticmethod
+    def crsp_chunk_queries(start_date, end_date):
+        """One crsp query per calendar month of [start_date, end_date], keyed by '<start>_<end>'."""
+        return {f'{chunk_start:%Y-%m-%d}_{chunk_end:%Y-%m-%d}':
+                WRDSConnection.crsp_query(f'{chunk_start:%Y-%m-%d}', f'{chunk_end:%Y-%m-%d}')
+                for chunk_start, chunk_end in WRDSConnection.month_chunks(start_date, end_date)}
+
+    @staticmethod
+    def crsp_query(start_date, end_date):
+        return f"""
             SELECT permno, date, ret, prc, shrout, cusip
             FROM crsp.dsf
             WHERE date BETWEEN '{start_date}' AND '{end_date}'
         """
-        return self.db.raw_sql(crsp_query)
+
+    @staticmethod
+    def month_chunks(start_date, end_date):
+        """Split [start_date, end_date] into calendar-month (start, end) pairs, clipped to the window."""
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        return [(max(month.start_time, start_date), min(month.end_time.normalize(), end_date))
+                for month in pd.period_range(start_date, end_date, freq='M')]
 
     def close(self):
         self.db.close()
\ No newline at end of file
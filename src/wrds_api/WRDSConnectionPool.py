@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+
+class WRDSConnectionPool:
+    """At most size connections, opened on first use and shared by queries running in parallel threads.
+    A connection serves one query at a time. A connection whose query fails is closed and replaced."""
+
+    def __init__(self, connect, size=4, retries=3, retry_delay=5):
+        # connect() opens a new connection, e.g. DataHandler.connect_to_wrds
+        self.connect = connect
+        self.size = size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def raw_sql(self, sql):
+        """Run one query on a free connection, retrying with exponential backoff if opening the connection or
+        the query fails."""
+        for attempt in range(self.retries + 1):
+            with self.slots:
+                connection = None
+                try:
+                    connection = self.acquire()
+                    result = connection.raw_sql(sql)
+                except Exception:
+                    if connection is not None:
+                        self.discard(connection)
+                    if attempt == self.retries:
+                        raise
+                else:
+                    self.idle.put(connection)
+                    return result
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def run_queries(self, queries, desc="Downloading"):
+        """Run {key: sql} queries in parallel, at most size at a time, with a single progress bar.
+        Yields (key, result) pairs as queries finish. Queries not yet started are cancelled if one fails."""
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = {executor.submit(self.raw_sql, sql): key for key, sql in queries.items()}
+            try:
+                with tqdm(total=len(futures), desc=desc, unit='query') as progress:
+                    for future in as_completed(futures):
+                        key = futures.pop(future)
+                        progress.update()
+                        yield key, future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+            with self.lock:
+                self.connections.append(connection)
+            return connection
+
+    def discard(self, connection):
+        with self.lock:
+            self.connections.remove(connection)
+        try:
+            connection.close()
+        except Exception:
+            pass  # The connection is already broken
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
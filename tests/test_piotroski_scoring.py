@@ -0,0 +1,8 @@
+from benchmarks.piotroski_scoring import check_parity, score_per_cusip
+from benchmarks.SyntheticData import SyntheticData
+from src.FactorEngine import FactorEngine
+
+
+def test_vectorized_scores_match_per_cusip_scoring():
+    funda = SyntheticData.funda(200, 6, seed=0)
+    check_parity(score_per_cusip(funda.copy()), FactorEngine.score(funda.copy(), ['piotroski']))
@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+
+from benchmarks.pipeline_benchmarks import MARKET_CAP_THRESHOLD, load_synthetic_data
+from src.DataHandler import DataHandler
+from src.StrategyRunner import StrategyRunner
+
+START_DATE, END_DATE = '1996-01-01', '2000-12-31'
+
+
+@pytest.fixture(scope='module')
+def synthetic_data():
+    _, funda, crsp = load_synthetic_data(150, 6, seed=1)
+    return funda, crsp
+
+
+def strategy_runner(synthetic_data, end_date=END_DATE, **kwargs):
+    """A runner on the synthetic data cleaned for START_DATE to end_date, as a run ending there would see it."""
+    funda, crsp = synthetic_data
+    crsp = crsp[(crsp['date'] >= START_DATE) & (crsp['date'] <= end_date)]
+    market_cap_index = DataHandler.build_market_cap_index(crsp.copy())
+    funda = DataHandler.clean_funda(funda.copy(), START_DATE, end_date, MARKET_CAP_THRESHOLD, crsp.copy(),
+                                    market_cap_index)
+    return StrategyRunner(funda, DataHandler.clean_crsp(crsp.copy()), 30, 20, 10, START_DATE, end_date, 60,
+                          market_cap_index=market_cap_index, market_cap_threshold=MARKET_CAP_THRESHOLD, **kwargs)
+
+
+def assert_same_run(runner, reference):
+    pd.testing.assert_frame_equal(runner.process_returns(), reference.process_returns())
+    pd.testing.assert_frame_equal(runner.holdings(), reference.holdings())
+
+
+def test_indexed_engine_matches_daily_engine(synthetic_data):
+    daily = strategy_runner(synthetic_data)
+    daily.run_strategy('daily', show_progress=False)
+    indexed = strategy_runner(synthetic_data)
+    indexed.run_strategy('indexed', show_progress=False)
+    assert_same_run(indexed, daily)
+
+
+@pytest.mark.parametrize('holdings_file', [False, True])
+def test_resume_after_interruption_matches_uninterrupted_run(synthetic_data, tmp_path, monkeypatch, holdings_file):
+    reference = strategy_runner(synthetic_data)
+    reference.run_strategy(show_progress=False)
+
+    holdings_path = str(tmp_path / 'holdings.parquet') if holdings_file else None
+    checkpoint_path = str(tmp_path / 'checkpoint.pkl')
+    interrupted = strategy_runner(synthetic_data, holdings_path=holdings_path)
+    calculate_returns = interrupted.calculate_indexed_daily_returns
+    trading_days = []
+
+    def crash_part_way(*args):
+        trading_days.append(args[0])
+        if len(trading_days) == 500:
+            raise KeyboardInterrupt
+        return calculate_returns(*args)
+    monkeypatch.setattr(interrupted, 'calculate_indexed_daily_returns', crash_part_way)
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.run_strategy(show_progress=False, checkpoint_path=checkpoint_path, checkpoint_every=100)
+
+    resumed = strategy_runner(synthetic_data, holdings_path=holdings_path)
+    resumed.run_strategy(show_progress=False, checkpoint_path=checkpoint_path, resume=True)
+    assert_same_run(resumed, reference)
+
+
+def test_extended_run_matches_uninterrupted_run(synthetic_data, tmp_path):
+    reference = strategy_runner(synthetic_data)
+    reference.run_strategy(show_progress=False)
+
+    checkpoint_path = str(tmp_path / 'checkpoint.pkl')
+    strategy_runner(synthetic_data, end_date='1998-06-30').run_strategy(show_progress=False,
+                                                                         checkpoint_path=checkpoint_path)
+    extended = strategy_runner(synthetic_data)
+    extended.run_strategy(show_progress=False, checkpoint_path=checkpoint_path, resume=True)
+    assert_same_run(extended, reference)